@@ -1,24 +1,30 @@
 import os
 import time
+import asyncio
 import hmac
 import hashlib
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from uuid import uuid4
 
 import jwt
+import httpx
+import orjson
 import boto3
 from botocore.client import Config
 import requests
 import stripe
 
 from fastapi import FastAPI, Depends, HTTPException, Query, UploadFile, File, Request
-from fastapi.responses import StreamingResponse, RedirectResponse
+from fastapi.responses import StreamingResponse, RedirectResponse, ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy import func, case, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from pydantic import BaseModel
 
 from models import (
-    SessionLocal, User, InviteCode, OTP, Job, Usage,
+    SessionLocal, AsyncSessionLocal, User, InviteCode, OTP, Job, Usage,
     Payment, TIER_CONFIG, generate_invite_code
 )  # noqa: F401
 
@@ -59,6 +65,48 @@ SMTP_FROM = os.getenv("SMTP_FROM")  # e.g., "PDF Translator <noreply@example.com
 # Frontend URL
 FRONTEND_URL = os.getenv("FRONTEND_URL", "https://mvp-frontend-rho.vercel.app")
 
+# Per-tier strings for crypto orders (TIER_CONFIG is static, so format once)
+TIER_DESCRIPTIONS = {
+    tier: f"PDF Translator - Tier {tier} ({cfg['words']:,} words)"
+    for tier, cfg in TIER_CONFIG.items()
+}
+TIER_AMOUNTS = {
+    (tier, asset): str(cfg[price_key])
+    for tier, cfg in TIER_CONFIG.items()
+    for asset, price_key in (("USDT", "price_usd"), ("TON", "price_ton"))
+}
+
+# Static parts of provider request bodies; per request only the
+# invite-code-dependent fields are added to a shallow copy
+WALLET_PAY_ORDER_TEMPLATES = {
+    tier: {
+        "amount": {"currencyCode": "USDT", "amount": TIER_AMOUNTS[(tier, "USDT")]},
+        "description": TIER_DESCRIPTIONS[tier],
+        "timeoutSeconds": 1800,  # 30 minutes
+        "failReturnUrl": f"{FRONTEND_URL}/payment/cancel",
+    }
+    for tier in TIER_CONFIG
+}
+CRYPTOBOT_INVOICE_TEMPLATES = {
+    (tier, asset): {
+        "asset": asset,
+        "amount": amount,
+        "description": TIER_DESCRIPTIONS[tier],
+        "paid_btn_name": "openBot",
+        "allow_comments": False,
+        "allow_anonymous": True,
+    }
+    for (tier, asset), amount in TIER_AMOUNTS.items()
+}
+WALLET_PAY_HEADERS = {
+    "Wpay-Store-Api-Key": WALLET_PAY_TOKEN or "",
+    "Content-Type": "application/json",
+}
+CRYPTOBOT_HEADERS = {
+    "Crypto-Pay-API-Token": CRYPTOBOT_API_TOKEN or "",
+    "Content-Type": "application/json",
+}
+
 # Initialize Stripe
 if STRIPE_SECRET_KEY:
     stripe.api_key = STRIPE_SECRET_KEY
@@ -75,7 +123,7 @@ if not R2_ACCESS_KEY:
 if not R2_SECRET_KEY:
     raise RuntimeError("R2_SECRET_KEY is missing")
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # ----------------------------
 # CORS (MVP-stable)
@@ -104,6 +152,22 @@ s3 = boto3.client(
 )
 
 
+# ----------------------------
+# Outbound HTTP (payment providers, Telegram)
+# - One shared async client: keep-alive + HTTP/2 multiplexing across requests
+# ----------------------------
+HTTPX = httpx.AsyncClient(
+    http2=True,
+    timeout=30,
+    limits=httpx.Limits(max_keepalive_connections=30, max_connections=100),
+)
+
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await HTTPX.aclose()
+
+
 # ----------------------------
 # DB
 # ----------------------------
@@ -115,6 +179,149 @@ def get_db():
         db.close()
 
 
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+# ----------------------------
+# In-process TTL cache
+# - Per uvicorn process; keys are namespaced (e.g. "app:v1:pay:cb:<code>")
+# ----------------------------
+TTL_CACHE_MAX_ENTRIES = 10_000
+PAYMENT_STATUS_TTL_PENDING = 3  # seconds; frontend polls every few seconds
+PAYMENT_STATUS_TTL_FINAL = 300
+
+# key -> (expires_at, value), oldest write first
+_ttl_cache: OrderedDict = OrderedDict()
+# Webhook dedupe keys live apart, so a burst of status polling can't push them out
+_webhook_seen: OrderedDict = OrderedDict()
+
+
+def ttl_cache_get(key: str, cache: OrderedDict = _ttl_cache):
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    expires_at, value = entry
+    if expires_at < time.monotonic():
+        cache.pop(key, None)
+        return None
+    return value
+
+
+def ttl_cache_set(key: str, value, ttl: float, cache: OrderedDict = _ttl_cache):
+    now = time.monotonic()
+    if len(cache) >= TTL_CACHE_MAX_ENTRIES:
+        for k in [k for k, (exp, _) in cache.items() if exp < now]:
+            del cache[k]
+        while len(cache) >= TTL_CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)  # still full of live entries: drop the oldest
+    cache.pop(key, None)  # re-set moves to the end
+    cache[key] = (now + ttl, value)
+
+
+# Webhook idempotency: providers retry deliveries, skip work already done
+WEBHOOK_DEDUPE_TTL = 3600
+WEBHOOK_MAX_BODY_BYTES = 64 * 1024
+
+
+def check_webhook_content_length(request: Request):
+    """Reject oversized webhook bodies before reading them."""
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > WEBHOOK_MAX_BODY_BYTES:
+        raise HTTPException(status_code=413, detail="Payload too large")
+
+
+def webhook_sig_key(signature: str) -> str:
+    return "app:v1:wh:sig:" + hashlib.blake2b(signature.encode(), digest_size=16).hexdigest()
+
+
+def verified_webhook(label: str, secret: str | None, sig_header: str, sign, ts_header: str | None = None):
+    """Build a dependency that bounds, verifies and parses a webhook body.
+
+    `sign(payload, timestamp)` returns the expected hex signature. The dependency
+    returns (data, signature); data is None for an already-processed delivery.
+    """
+    async def dependency(request: Request):
+        check_webhook_content_length(request)
+
+        signature = request.headers.get(sig_header)
+        timestamp = request.headers.get(ts_header) if ts_header else None
+
+        if secret and (not signature or (ts_header and not timestamp)):
+            print(f"[{label}] Missing signature headers", flush=True)
+            raise HTTPException(status_code=401, detail="Missing signature")
+
+        # Same signature already handled -> same body, nothing to do
+        if signature and ttl_cache_get(webhook_sig_key(signature), _webhook_seen):
+            print(f"[{label}] Duplicate delivery, skipping", flush=True)
+            return None, signature
+
+        payload = await request.body()
+        if len(payload) > WEBHOOK_MAX_BODY_BYTES:
+            raise HTTPException(status_code=413, detail="Payload too large")
+
+        if secret and not hmac.compare_digest(signature, sign(payload, timestamp)):
+            print(f"[{label}] Invalid signature", flush=True)
+            raise HTTPException(status_code=400, detail="Invalid signature")
+
+        try:
+            data = orjson.loads(payload)
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid JSON")
+
+        return data, signature
+
+    return dependency
+
+
+def mark_webhook_processed(dedupe_key: str, signature: str | None):
+    ttl_cache_set(dedupe_key, True, WEBHOOK_DEDUPE_TTL, _webhook_seen)
+    if signature:
+        ttl_cache_set(webhook_sig_key(signature), True, WEBHOOK_DEDUPE_TTL, _webhook_seen)
+
+
+def payment_status_response(payment) -> dict:
+    return {
+        "status": payment.status,
+        "tier": payment.tier,
+        "quota_words": payment.quota_words,
+        "invite_code": payment.invite_code if payment.status == "completed" else None,
+    }
+
+
+def cache_payment_status(key: str, payment) -> dict:
+    resp = payment_status_response(payment)
+    ttl = PAYMENT_STATUS_TTL_PENDING if resp["status"] == "pending" else PAYMENT_STATUS_TTL_FINAL
+    ttl_cache_set(key, resp, ttl)
+    return resp
+
+
+# ----------------------------
+# Invite code issuing
+# - Collision check against an in-memory set instead of a SELECT per attempt
+# - Exact set rather than a bloom filter: ~100 bytes per code is fine at our
+#   volume, and there are no false positives to regenerate on
+# - The unique index on app_payments.invite_code stays the real backstop
+#   (other uvicorn processes' codes are only known after their restart)
+# ----------------------------
+_issued_invite_codes: set[str] = set()
+
+
+def load_issued_invite_codes(db: Session):
+    result = db.execute(select(Payment.invite_code).execution_options(yield_per=10_000))
+    for rows in result.partitions():
+        _issued_invite_codes.update(code for (code,) in rows)
+
+
+def new_invite_code() -> str:
+    invite_code = generate_invite_code()
+    while invite_code in _issued_invite_codes:
+        invite_code = generate_invite_code()
+    _issued_invite_codes.add(invite_code)
+    return invite_code
+
+
 # ----------------------------
 # JWT helpers
 # ----------------------------
@@ -574,11 +781,7 @@ def create_stripe_checkout(req: CreateCheckoutRequest, db: Session = Depends(get
     price_cents = int(config["price_eur"] * 100)
 
     # Generate unique invite code
-    invite_code = generate_invite_code()
-
-    # Ensure uniqueness
-    while db.query(Payment).filter(Payment.invite_code == invite_code).first():
-        invite_code = generate_invite_code()
+    invite_code = new_invite_code()
 
     try:
         # Create Stripe Checkout Session
@@ -634,7 +837,7 @@ def create_stripe_checkout(req: CreateCheckoutRequest, db: Session = Depends(get
 
 
 @app.post("/webhook/stripe")
-async def stripe_webhook(request: Request, db: Session = Depends(get_db)):
+async def stripe_webhook(request: Request, db: AsyncSession = Depends(get_async_db)):
     """Handle Stripe webhook events"""
     payload = await request.body()
     sig_header = request.headers.get("stripe-signature")
@@ -668,7 +871,9 @@ async def stripe_webhook(request: Request, db: Session = Depends(get_db)):
 
         if payment_status == "paid":
             # Find payment record
-            payment = db.query(Payment).filter(Payment.stripe_session_id == session_id).first()
+            payment = (await db.execute(
+                select(Payment).where(Payment.stripe_session_id == session_id)
+            )).scalars().first()
 
             if not payment:
                 print(f"[STRIPE WEBHOOK] Payment not found for session {session_id}", flush=True)
@@ -684,7 +889,9 @@ async def stripe_webhook(request: Request, db: Session = Depends(get_db)):
             payment.stripe_payment_intent = session.get("payment_intent")
 
             # Also create an InviteCode record for backward compatibility
-            existing_code = db.query(InviteCode).filter(InviteCode.code == payment.invite_code).first()
+            existing_code = (await db.execute(
+                select(InviteCode).where(InviteCode.code == payment.invite_code)
+            )).scalars().first()
             if not existing_code:
                 invite = InviteCode(
                     code=payment.invite_code,
@@ -695,13 +902,14 @@ async def stripe_webhook(request: Request, db: Session = Depends(get_db)):
                 )
                 db.add(invite)
 
-            db.commit()
+            await db.commit()
 
             print(f"[STRIPE WEBHOOK] Payment completed! code={payment.invite_code} tier={payment.tier}", flush=True)
 
-            # Send email with invite code if email provided
+            # Send email with invite code if email provided (SMTP is blocking)
             if payment.email:
-                send_invite_code_email(
+                await asyncio.to_thread(
+                    send_invite_code_email,
                     to_email=payment.email,
                     invite_code=payment.invite_code,
                     tier=payment.tier,
@@ -732,7 +940,7 @@ def get_stripe_session(session_id: str, db: Session = Depends(get_db)):
 # ========================================
 
 @app.post("/api/wallet-pay/create-order")
-def create_wallet_pay_order(req: WalletPayOrderRequest, db: Session = Depends(get_db)):
+async def create_wallet_pay_order(req: WalletPayOrderRequest, db: AsyncSession = Depends(get_async_db)):
     """Create Wallet Pay order for crypto payment"""
     if not WALLET_PAY_TOKEN:
         raise HTTPException(status_code=503, detail="Wallet Pay not configured")
@@ -744,34 +952,22 @@ def create_wallet_pay_order(req: WalletPayOrderRequest, db: Session = Depends(ge
     config = TIER_CONFIG[tier]
 
     # Generate unique invite code
-    invite_code = generate_invite_code()
-    while db.query(Payment).filter(Payment.invite_code == invite_code).first():
-        invite_code = generate_invite_code()
+    invite_code = new_invite_code()
 
     # Create order via Wallet Pay API
     # https://docs.wallet.tg/pay/
-    order_id = f"order_{int(time.time())}_{invite_code}"
+    order_id = f"order_{time.time_ns() // 1_000_000_000}_{invite_code}"
+
+    order = WALLET_PAY_ORDER_TEMPLATES[tier].copy()
+    order["externalId"] = order_id
+    order["customerTelegramUserId"] = int(req.telegram_user_id)
+    order["returnUrl"] = f"{FRONTEND_URL}/payment/success?order_id={order_id}"
 
     try:
-        response = requests.post(
+        response = await HTTPX.post(
             "https://pay.wallet.tg/wpay/store-api/v1/order",
-            headers={
-                "Wpay-Store-Api-Key": WALLET_PAY_TOKEN,
-                "Content-Type": "application/json",
-            },
-            json={
-                "amount": {
-                    "currencyCode": "USDT",
-                    "amount": str(config["price_usd"]),
-                },
-                "description": f"PDF Translator - Tier {tier} ({config['words']:,} words)",
-                "externalId": order_id,
-                "timeoutSeconds": 1800,  # 30 minutes
-                "customerTelegramUserId": int(req.telegram_user_id),
-                "returnUrl": f"{FRONTEND_URL}/payment/success?order_id={order_id}",
-                "failReturnUrl": f"{FRONTEND_URL}/payment/cancel",
-            },
-            timeout=30,
+            headers=WALLET_PAY_HEADERS,
+            json=order,
         )
         response.raise_for_status()
         data = response.json()
@@ -795,7 +991,7 @@ def create_wallet_pay_order(req: WalletPayOrderRequest, db: Session = Depends(ge
             status="pending",
         )
         db.add(payment)
-        db.commit()
+        await db.commit()
 
         print(f"[WALLET PAY] Created order={order_id} tier={tier} code={invite_code}", flush=True)
 
@@ -804,39 +1000,36 @@ def create_wallet_pay_order(req: WalletPayOrderRequest, db: Session = Depends(ge
             "order_id": order_id,
         }
 
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"[WALLET PAY] Request error: {e}", flush=True)
         raise HTTPException(status_code=500, detail="Failed to connect to Wallet Pay")
 
 
-@app.post("/webhook/wallet-pay")
-async def wallet_pay_webhook(request: Request, db: Session = Depends(get_db)):
-    """Handle Wallet Pay webhook events"""
-    payload = await request.body()
+# https://docs.wallet.tg/pay/#section/Webhooks
+# Signature: HMAC-SHA256("<timestamp>.<body>") keyed with the store API key
+def wallet_pay_signature(payload: bytes, timestamp: str | None) -> str:
+    return hmac.new(
+        WALLET_PAY_TOKEN.encode(),
+        timestamp.encode() + b"." + payload,
+        hashlib.sha256
+    ).hexdigest()
 
-    # Verify webhook signature
-    # https://docs.wallet.tg/pay/#section/Webhooks
-    timestamp = request.headers.get("WalletPay-Timestamp")
-    signature = request.headers.get("WalletPay-Signature")
-
-    if WALLET_PAY_TOKEN and timestamp and signature:
-        # Compute expected signature
-        message = f"{timestamp}.{payload.decode()}"
-        expected_sig = hmac.new(
-            WALLET_PAY_TOKEN.encode(),
-            message.encode(),
-            hashlib.sha256
-        ).hexdigest()
-
-        if not hmac.compare_digest(signature, expected_sig):
-            print("[WALLET PAY WEBHOOK] Invalid signature", flush=True)
-            raise HTTPException(status_code=400, detail="Invalid signature")
 
-    try:
-        import json
-        data = json.loads(payload)
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid JSON")
+wallet_pay_verified = verified_webhook(
+    "WALLET PAY WEBHOOK", WALLET_PAY_TOKEN, "WalletPay-Signature", wallet_pay_signature,
+    ts_header="WalletPay-Timestamp",
+)
+
+
+@app.post("/webhook/wallet-pay")
+async def wallet_pay_webhook(
+    delivery: tuple = Depends(wallet_pay_verified),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Handle Wallet Pay webhook events"""
+    data, signature = delivery
+    if data is None:
+        return {"status": "ok"}
 
     print(f"[WALLET PAY WEBHOOK] Received: {data}", flush=True)
 
@@ -850,7 +1043,14 @@ async def wallet_pay_webhook(request: Request, db: Session = Depends(get_db)):
             print("[WALLET PAY WEBHOOK] Missing externalId", flush=True)
             return {"status": "error"}
 
-        payment = db.query(Payment).filter(Payment.wallet_pay_order_id == order_id).first()
+        dedupe_key = f"app:v1:wh:wp:{order_id}"
+        if ttl_cache_get(dedupe_key, _webhook_seen):
+            print(f"[WALLET PAY WEBHOOK] Order already processed: {order_id}", flush=True)
+            return {"status": "ok"}
+
+        payment = (await db.execute(
+            select(Payment).where(Payment.wallet_pay_order_id == order_id)
+        )).scalars().first()
 
         if not payment:
             print(f"[WALLET PAY WEBHOOK] Payment not found for order {order_id}", flush=True)
@@ -858,6 +1058,7 @@ async def wallet_pay_webhook(request: Request, db: Session = Depends(get_db)):
 
         if payment.status == "completed":
             print(f"[WALLET PAY WEBHOOK] Payment already completed: {order_id}", flush=True)
+            mark_webhook_processed(dedupe_key, signature)
             return {"status": "ok"}
 
         # Update payment status
@@ -865,7 +1066,9 @@ async def wallet_pay_webhook(request: Request, db: Session = Depends(get_db)):
         payment.completed_at = datetime.utcnow()
 
         # Create InviteCode record
-        existing_code = db.query(InviteCode).filter(InviteCode.code == payment.invite_code).first()
+        existing_code = (await db.execute(
+            select(InviteCode).where(InviteCode.code == payment.invite_code)
+        )).scalars().first()
         if not existing_code:
             invite = InviteCode(
                 code=payment.invite_code,
@@ -876,14 +1079,16 @@ async def wallet_pay_webhook(request: Request, db: Session = Depends(get_db)):
             )
             db.add(invite)
 
-        db.commit()
+        await db.commit()
+        cache_payment_status(f"app:v1:pay:wp:{order_id}", payment)
+        mark_webhook_processed(dedupe_key, signature)
 
         print(f"[WALLET PAY WEBHOOK] Payment completed! code={payment.invite_code} tier={payment.tier}", flush=True)
 
         # TODO: Send code to user via Telegram Bot
         if payment.telegram_user_id and TELEGRAM_BOT_TOKEN:
             try:
-                requests.post(
+                await HTTPX.post(
                     f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
                     json={
                         "chat_id": payment.telegram_user_id,
@@ -899,19 +1104,21 @@ async def wallet_pay_webhook(request: Request, db: Session = Depends(get_db)):
 
 
 @app.get("/api/wallet-pay/order/{order_id}")
-def get_wallet_pay_order(order_id: str, db: Session = Depends(get_db)):
+async def get_wallet_pay_order(order_id: str, db: AsyncSession = Depends(get_async_db)):
     """Get payment status and invite code after successful payment"""
-    payment = db.query(Payment).filter(Payment.wallet_pay_order_id == order_id).first()
+    cache_key = f"app:v1:pay:wp:{order_id}"
+    cached = ttl_cache_get(cache_key)
+    if cached is not None:
+        return cached
+
+    payment = (await db.execute(
+        select(Payment).where(Payment.wallet_pay_order_id == order_id)
+    )).scalars().first()
 
     if not payment:
         raise HTTPException(status_code=404, detail="Payment not found")
 
-    return {
-        "status": payment.status,
-        "tier": payment.tier,
-        "quota_words": payment.quota_words,
-        "invite_code": payment.invite_code if payment.status == "completed" else None,
-    }
+    return cache_payment_status(cache_key, payment)
 
 
 # ========================================
@@ -919,7 +1126,7 @@ def get_wallet_pay_order(order_id: str, db: Session = Depends(get_db)):
 # ========================================
 
 @app.post("/api/cryptobot/create-invoice")
-def create_cryptobot_invoice(req: CryptoBotInvoiceRequest, db: Session = Depends(get_db)):
+async def create_cryptobot_invoice(req: CryptoBotInvoiceRequest, db: AsyncSession = Depends(get_async_db)):
     """Create CryptoBot invoice for crypto payment (USDT/TON)"""
     if not CRYPTOBOT_API_TOKEN:
         raise HTTPException(status_code=503, detail="CryptoBot not configured")
@@ -934,40 +1141,25 @@ def create_cryptobot_invoice(req: CryptoBotInvoiceRequest, db: Session = Depends
 
     config = TIER_CONFIG[tier]
 
-    # Determine amount based on asset
-    if asset == "USDT":
-        amount = str(config["price_usd"])
-    else:  # TON
-        amount = str(config["price_ton"])
+    amount = TIER_AMOUNTS[(tier, asset)]
 
     # Generate unique invite code
-    invite_code = generate_invite_code()
-    while db.query(Payment).filter(Payment.invite_code == invite_code).first():
-        invite_code = generate_invite_code()
+    invite_code = new_invite_code()
+
+    invoice_req = CRYPTOBOT_INVOICE_TEMPLATES[(tier, asset)].copy()
+    invoice_req["hidden_message"] = f"Your activation code: {invite_code}"
+    invoice_req["paid_btn_url"] = f"{FRONTEND_URL}/payment/success?crypto_invoice={invite_code}"
+    invoice_req["payload"] = f"{tier}:{invite_code}"
 
     # Create invoice via CryptoBot API
     try:
         print(f"[CRYPTOBOT] Creating invoice: tier={tier} asset={asset} amount={amount}", flush=True)
         print(f"[CRYPTOBOT] API URL: {CRYPTOBOT_API_URL}/createInvoice", flush=True)
 
-        response = requests.post(
+        response = await HTTPX.post(
             f"{CRYPTOBOT_API_URL}/createInvoice",
-            headers={
-                "Crypto-Pay-API-Token": CRYPTOBOT_API_TOKEN,
-                "Content-Type": "application/json",
-            },
-            json={
-                "asset": asset,
-                "amount": amount,
-                "description": f"PDF Translator - Tier {tier} ({config['words']:,} words)",
-                "hidden_message": f"Your activation code: {invite_code}",
-                "paid_btn_name": "openBot",
-                "paid_btn_url": f"{FRONTEND_URL}/payment/success?crypto_invoice={invite_code}",
-                "payload": f"{tier}:{invite_code}",
-                "allow_comments": False,
-                "allow_anonymous": True,
-            },
-            timeout=30,
+            headers=CRYPTOBOT_HEADERS,
+            json=invoice_req,
         )
 
         print(f"[CRYPTOBOT] Response status: {response.status_code}", flush=True)
@@ -997,7 +1189,7 @@ def create_cryptobot_invoice(req: CryptoBotInvoiceRequest, db: Session = Depends
             status="pending",
         )
         db.add(payment)
-        db.commit()
+        await db.commit()
 
         print(f"[CRYPTOBOT] Created invoice={invoice_id} tier={tier} code={invite_code} asset={asset}", flush=True)
 
@@ -1006,39 +1198,36 @@ def create_cryptobot_invoice(req: CryptoBotInvoiceRequest, db: Session = Depends
             "invoice_id": invoice_id,
         }
 
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"[CRYPTOBOT] Request error: {e}", flush=True)
         if hasattr(e, 'response') and e.response is not None:
             print(f"[CRYPTOBOT] Error response: {e.response.text}", flush=True)
         raise HTTPException(status_code=500, detail="Failed to connect to CryptoBot")
 
 
-@app.post("/webhook/cryptobot")
-async def cryptobot_webhook(request: Request, db: Session = Depends(get_db)):
-    """Handle CryptoBot webhook events"""
-    payload = await request.body()
+# CryptoBot sends signature in Crypto-Pay-Api-Signature header:
+# HMAC-SHA256 of request body keyed with SHA256(API token)
+CRYPTOBOT_WEBHOOK_KEY = hashlib.sha256(CRYPTOBOT_API_TOKEN.encode()).digest() if CRYPTOBOT_API_TOKEN else b""
 
-    # Verify webhook signature
-    # CryptoBot sends signature in Crypto-Pay-Api-Signature header
-    signature = request.headers.get("Crypto-Pay-Api-Signature")
 
-    if CRYPTOBOT_API_TOKEN and signature:
-        # Compute expected signature: HMAC-SHA256 of request body with API token
-        expected_sig = hmac.new(
-            hashlib.sha256(CRYPTOBOT_API_TOKEN.encode()).digest(),
-            payload,
-            hashlib.sha256
-        ).hexdigest()
+def cryptobot_signature(payload: bytes, _timestamp: str | None) -> str:
+    return hmac.new(CRYPTOBOT_WEBHOOK_KEY, payload, hashlib.sha256).hexdigest()
 
-        if not hmac.compare_digest(signature, expected_sig):
-            print("[CRYPTOBOT WEBHOOK] Invalid signature", flush=True)
-            raise HTTPException(status_code=400, detail="Invalid signature")
 
-    try:
-        import json
-        data = json.loads(payload)
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid JSON")
+cryptobot_verified = verified_webhook(
+    "CRYPTOBOT WEBHOOK", CRYPTOBOT_API_TOKEN, "Crypto-Pay-Api-Signature", cryptobot_signature,
+)
+
+
+@app.post("/webhook/cryptobot")
+async def cryptobot_webhook(
+    delivery: tuple = Depends(cryptobot_verified),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """Handle CryptoBot webhook events"""
+    data, signature = delivery
+    if data is None:
+        return {"status": "ok"}
 
     print(f"[CRYPTOBOT WEBHOOK] Received: {data}", flush=True)
 
@@ -1056,15 +1245,24 @@ async def cryptobot_webhook(request: Request, db: Session = Depends(get_db)):
             print(f"[CRYPTOBOT WEBHOOK] Invalid payload format: {payload_str}", flush=True)
             return {"status": "error"}
 
+        dedupe_key = f"app:v1:wh:cb:{invoice_id}"
+        if ttl_cache_get(dedupe_key, _webhook_seen):
+            print(f"[CRYPTOBOT WEBHOOK] Invoice already processed: {invoice_id}", flush=True)
+            return {"status": "ok"}
+
         # Find payment by invoice_id
-        payment = db.query(Payment).filter(Payment.cryptobot_invoice_id == invoice_id).first()
+        payment = (await db.execute(
+            select(Payment).where(Payment.cryptobot_invoice_id == invoice_id)
+        )).scalars().first()
 
         if not payment:
             # Try to find by invite_code as fallback
-            payment = db.query(Payment).filter(
-                Payment.invite_code == invite_code,
-                Payment.payment_method == "cryptobot"
-            ).first()
+            payment = (await db.execute(
+                select(Payment).where(
+                    Payment.invite_code == invite_code,
+                    Payment.payment_method == "cryptobot"
+                )
+            )).scalars().first()
 
         if not payment:
             print(f"[CRYPTOBOT WEBHOOK] Payment not found for invoice {invoice_id}", flush=True)
@@ -1072,6 +1270,7 @@ async def cryptobot_webhook(request: Request, db: Session = Depends(get_db)):
 
         if payment.status == "completed":
             print(f"[CRYPTOBOT WEBHOOK] Payment already completed: {invoice_id}", flush=True)
+            mark_webhook_processed(dedupe_key, signature)
             return {"status": "ok"}
 
         # Update payment status
@@ -1079,7 +1278,9 @@ async def cryptobot_webhook(request: Request, db: Session = Depends(get_db)):
         payment.completed_at = datetime.utcnow()
 
         # Create InviteCode record for backward compatibility
-        existing_code = db.query(InviteCode).filter(InviteCode.code == payment.invite_code).first()
+        existing_code = (await db.execute(
+            select(InviteCode).where(InviteCode.code == payment.invite_code)
+        )).scalars().first()
         if not existing_code:
             invite = InviteCode(
                 code=payment.invite_code,
@@ -1090,13 +1291,16 @@ async def cryptobot_webhook(request: Request, db: Session = Depends(get_db)):
             )
             db.add(invite)
 
-        db.commit()
+        await db.commit()
+        cache_payment_status(f"app:v1:pay:cb:{payment.invite_code}", payment)
+        mark_webhook_processed(dedupe_key, signature)
 
         print(f"[CRYPTOBOT WEBHOOK] Payment completed! code={payment.invite_code} tier={payment.tier}", flush=True)
 
-        # Send email with invite code if email provided
+        # Send email with invite code if email provided (SMTP is blocking)
         if payment.email:
-            send_invite_code_email(
+            await asyncio.to_thread(
+                send_invite_code_email,
                 to_email=payment.email,
                 invite_code=payment.invite_code,
                 tier=payment.tier,
@@ -1107,55 +1311,127 @@ async def cryptobot_webhook(request: Request, db: Session = Depends(get_db)):
 
 
 @app.get("/api/cryptobot/invoice/{invoice_code}")
-def get_cryptobot_invoice(invoice_code: str, db: Session = Depends(get_db)):
+async def get_cryptobot_invoice(invoice_code: str, db: AsyncSession = Depends(get_async_db)):
     """Get payment status and invite code by invite_code (from success URL)"""
-    payment = db.query(Payment).filter(
-        Payment.invite_code == invoice_code,
-        Payment.payment_method == "cryptobot"
-    ).first()
+    cache_key = f"app:v1:pay:cb:{invoice_code}"
+    cached = ttl_cache_get(cache_key)
+    if cached is not None:
+        return cached
+
+    payment = (await db.execute(
+        select(Payment).where(
+            Payment.invite_code == invoice_code,
+            Payment.payment_method == "cryptobot"
+        )
+    )).scalars().first()
 
     if not payment:
         raise HTTPException(status_code=404, detail="Payment not found")
 
-    return {
-        "status": payment.status,
-        "tier": payment.tier,
-        "quota_words": payment.quota_words,
-        "invite_code": payment.invite_code if payment.status == "completed" else None,
-    }
+    return cache_payment_status(cache_key, payment)
 
 
 # ========================================
 # ADMIN PANEL
 # ========================================
+ADMIN_STREAM_BATCH = 500  # rows fetched per server-side cursor round-trip
+
+
+def stream_batches(result):
+    """
+    Row batches of a yield_per result, with the first one fetched right away: errors
+    that would otherwise surface after a 200 has been sent are raised to the caller.
+    """
+    partitions = result.partitions()
+    first = next(partitions, None)
+
+    def batches():
+        if first is not None:
+            yield first
+            yield from partitions
+
+    return batches()
+
+
 @app.get("/api/admin/codes")
-def admin_list_codes(admin_secret: str = Query(...), db: Session = Depends(get_db)):
+def admin_list_codes(admin_secret: str = Query(...)):
     """Список всех инвайт-кодов с их статусом"""
     if admin_secret != ADMIN_SECRET:
         raise HTTPException(status_code=403, detail="Invalid admin secret")
 
-    codes = db.query(InviteCode).order_by(InviteCode.tier.desc(), InviteCode.code).all()
-
-    return {
-        "total": len(codes),
-        "codes": [
-            {
-                "code": c.code,
-                "tier": c.tier,
-                "quota_words": c.quota_words,
-                "max_uses": c.max_uses,
-                "used_count": c.used_count,
-                "available": c.max_uses - c.used_count > 0,
-            }
-            for c in codes
-        ],
-        "stats": {
-            "tier_M_total": sum(1 for c in codes if c.tier == "M"),
-            "tier_M_used": sum(1 for c in codes if c.tier == "M" and c.used_count > 0),
-            "tier_S_total": sum(1 for c in codes if c.tier == "S"),
-            "tier_S_used": sum(1 for c in codes if c.tier == "S" and c.used_count > 0),
+    # Queries run (and the first batch is fetched) before the response starts, so a DB
+    # failure here is still a 500. Own session: it has to outlive the endpoint while
+    # the body is streamed.
+    db = SessionLocal()
+    try:
+        tier_stats = {
+            tier: (total, used or 0)
+            for tier, total, used in (
+                db.query(
+                    InviteCode.tier,
+                    func.count(),
+                    func.sum(case((InviteCode.used_count > 0, 1), else_=0)),
+                )
+                .group_by(InviteCode.tier)
+                .all()
+            )
         }
-    }
+        # Plain column tuples: no ORM instance hydration for the full table
+        batches = stream_batches(db.execute(
+            select(
+                InviteCode.code,
+                InviteCode.tier,
+                InviteCode.quota_words,
+                InviteCode.max_uses,
+                InviteCode.used_count,
+            )
+            .order_by(InviteCode.tier.desc(), InviteCode.code)
+            .execution_options(yield_per=ADMIN_STREAM_BATCH)
+        ))
+    except Exception:
+        db.close()
+        raise
+
+    m_total, m_used = tier_stats.get("M", (0, 0))
+    s_total, s_used = tier_stats.get("S", (0, 0))
+
+    def generate():
+        try:
+            yield (
+                b'{"total":' + orjson.dumps(sum(total for total, _ in tier_stats.values()))
+                + b',"stats":' + orjson.dumps({
+                    "tier_M_total": m_total,
+                    "tier_M_used": m_used,
+                    "tier_S_total": s_total,
+                    "tier_S_used": s_used,
+                })
+                + b',"codes":['
+            )
+            try:
+                sep = b""
+                for rows in batches:
+                    yield sep + b",".join(
+                        orjson.dumps({
+                            "code": code,
+                            "tier": tier,
+                            "quota_words": quota_words,
+                            "max_uses": max_uses,
+                            "used_count": used_count,
+                            "available": max_uses - used_count > 0,
+                        })
+                        for code, tier, quota_words, max_uses, used_count in rows
+                    )
+                    sep = b","
+            except Exception as e:
+                # Headers are gone already: close the JSON and flag the truncation
+                print(f"[ADMIN] codes stream failed: {e}", flush=True)
+                yield b'],"error":"stream interrupted"}'
+                return
+            yield b"]}"
+        finally:
+            db.close()
+
+    return StreamingResponse(generate(), media_type="application/json")
 
 
 @app.get("/api/admin/stats")
@@ -1191,75 +1467,100 @@ def admin_stats(admin_secret: str = Query(...), db: Session = Depends(get_db)):
 
 
 @app.get("/api/admin/payments")
-def admin_list_payments(admin_secret: str = Query(...), db: Session = Depends(get_db)):
+def admin_list_payments(admin_secret: str = Query(...)):
     """Список всех платежей"""
     if admin_secret != ADMIN_SECRET:
         raise HTTPException(status_code=403, detail="Invalid admin secret")
 
-    payments = db.query(Payment).order_by(Payment.created_at.desc()).limit(100).all()
+    # Query runs (and the first batch is fetched) before the response starts, so a DB
+    # failure here is still a 500
+    db = SessionLocal()
+    try:
+        batches = stream_batches(db.execute(
+            select(
+                Payment.id,
+                Payment.invite_code,
+                Payment.tier,
+                Payment.amount,
+                Payment.currency,
+                Payment.payment_method,
+                Payment.status,
+                Payment.email,
+                Payment.telegram_user_id,
+                Payment.created_at,
+                Payment.completed_at,
+            )
+            .order_by(Payment.created_at.desc())
+            .limit(100)
+            .execution_options(yield_per=ADMIN_STREAM_BATCH)
+        ))
+    except Exception:
+        db.close()
+        raise
 
-    return {
-        "total": len(payments),
-        "payments": [
-            {
-                "id": p.id,
-                "invite_code": p.invite_code,
-                "tier": p.tier,
-                "amount": p.amount,
-                "currency": p.currency,
-                "payment_method": p.payment_method,
-                "status": p.status,
-                "email": p.email,
-                "telegram_user_id": p.telegram_user_id,
-                "created_at": p.created_at.isoformat() if p.created_at else None,
-                "completed_at": p.completed_at.isoformat() if p.completed_at else None,
-            }
-            for p in payments
-        ],
-        "stats": {
-            "total_completed": sum(1 for p in payments if p.status == "completed"),
-            "total_pending": sum(1 for p in payments if p.status == "pending"),
-            "revenue_eur": sum(p.amount for p in payments if p.status == "completed" and p.currency == "EUR"),
-            "revenue_usd": sum(p.amount for p in payments if p.status == "completed" and p.currency in ["USD", "USDT"]),
-        }
-    }
+    def generate():
+        try:
+            # Stats are accumulated while streaming and emitted after the list
+            total = total_completed = total_pending = 0
+            revenue_eur = revenue_usd = 0
 
+            yield b'{"payments":['
+            try:
+                sep = b""
+                for rows in batches:
+                    parts = []
+                    for p in rows:
+                        total += 1
+                        if p.status == "completed":
+                            total_completed += 1
+                            if p.currency == "EUR":
+                                revenue_eur += p.amount
+                            elif p.currency in ["USD", "USDT"]:
+                                revenue_usd += p.amount
+                        elif p.status == "pending":
+                            total_pending += 1
+                        parts.append(orjson.dumps({
+                            "id": p.id,
+                            "invite_code": p.invite_code,
+                            "tier": p.tier,
+                            "amount": p.amount,
+                            "currency": p.currency,
+                            "payment_method": p.payment_method,
+                            "status": p.status,
+                            "email": p.email,
+                            "telegram_user_id": p.telegram_user_id,
+                            "created_at": p.created_at.isoformat() if p.created_at else None,
+                            "completed_at": p.completed_at.isoformat() if p.completed_at else None,
+                        }))
+                    yield sep + b",".join(parts)
+                    sep = b","
+            except Exception as e:
+                # Headers are gone already: close the JSON and flag the truncation
+                print(f"[ADMIN] payments stream failed: {e}", flush=True)
+                yield b'],"error":"stream interrupted"}'
+                return
+
+            yield (
+                b'],"total":' + orjson.dumps(total)
+                + b',"stats":' + orjson.dumps({
+                    "total_completed": total_completed,
+                    "total_pending": total_pending,
+                    "revenue_eur": revenue_eur,
+                    "revenue_usd": revenue_usd,
+                })
+                + b"}"
+            )
+        finally:
+            db.close()
 
-# Initialize tables on startup
-from models import init_db, Base, engine
-try:
-    Base.metadata.create_all(bind=engine)
-    print("[STARTUP] Database tables initialized", flush=True)
+    return StreamingResponse(generate(), media_type="application/json")
 
-    # Migration: Add cryptobot_invoice_id column if it doesn't exist
-    with engine.connect() as conn:
-        from sqlalchemy import text
-        try:
-            conn.execute(text("""
-                ALTER TABLE app_payments
-                ADD COLUMN IF NOT EXISTS cryptobot_invoice_id VARCHAR UNIQUE
-            """))
-            conn.commit()
-            print("[STARTUP] Migration: cryptobot_invoice_id column ready", flush=True)
-        except Exception as migration_err:
-            print(f"[STARTUP] Migration note: {migration_err}", flush=True)
-
-    # Migration: Add max_pages column to app_users and app_invite_codes
-    with engine.connect() as conn:
-        from sqlalchemy import text
-        try:
-            conn.execute(text("""
-                ALTER TABLE app_users
-                ADD COLUMN IF NOT EXISTS max_pages INTEGER
-            """))
-            conn.execute(text("""
-                ALTER TABLE app_invite_codes
-                ADD COLUMN IF NOT EXISTS max_pages INTEGER
-            """))
-            conn.commit()
-            print("[STARTUP] Migration: max_pages columns ready", flush=True)
-        except Exception as migration_err:
-            print(f"[STARTUP] Migration note (max_pages): {migration_err}", flush=True)
+
+# Initialize tables and run migrations on startup (the worker runs the same on its start)
+from models import ensure_schema
+try:
+    ensure_schema()
+    print("[STARTUP] Database schema ready", flush=True)
 
     # Create TEST trial code if it doesn't exist
     try:
@@ -1283,6 +1584,15 @@ try:
     except Exception as test_code_err:
         print(f"[STARTUP] TEST code creation note: {test_code_err}", flush=True)
 
+    # Warm the invite code collision set
+    try:
+        db = SessionLocal()
+        load_issued_invite_codes(db)
+        db.close()
+        print(f"[STARTUP] Loaded {len(_issued_invite_codes)} issued invite codes", flush=True)
+    except Exception as codes_err:
+        print(f"[STARTUP] Invite code preload note: {codes_err}", flush=True)
+
 except Exception as e:
     print(f"[STARTUP] DB init error: {e}", flush=True)
 
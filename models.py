@@ -1,6 +1,9 @@
 import os
+import re
 import sys
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, ForeignKey, Text, Float
+from sqlalchemy import create_engine, inspect, text, Column, Integer, String, Boolean, DateTime, ForeignKey, Text, Float
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import sessionmaker, relationship, declarative_base
 from datetime import datetime
 import secrets
@@ -16,9 +19,47 @@ if not database_url:
 if database_url.startswith("postgres://"):
     database_url = database_url.replace("postgres://", "postgresql://", 1)
 
+# URL query parameters asyncpg (or SQLAlchemy's asyncpg dialect) takes as they are
+ASYNCPG_URL_PARAMS = {"target_session_attrs", "prepared_statement_cache_size"}
+
+
+def asyncpg_url_and_args(url):
+    """
+    (URL, connect_args) for asyncpg from a libpq-style URL. asyncpg.connect() raises
+    TypeError on libpq's query parameters, so the ones with an asyncpg equivalent are
+    translated and the rest (channel_binding, gssencmode, ...) are dropped.
+    """
+    query = {k: v for k, v in url.query.items() if isinstance(v, str)}
+    connect_args = {}
+    server_settings = {}
+    if "sslmode" in query:
+        connect_args["ssl"] = query.pop("sslmode")
+    if "connect_timeout" in query:
+        connect_args["timeout"] = float(query.pop("connect_timeout"))
+    if "application_name" in query:
+        server_settings["application_name"] = query.pop("application_name")
+    if "options" in query:
+        # "-c search_path=app -c statement_timeout=5000"
+        for name, value in re.findall(r"-c\s*([\w.]+)=(\S+)", query.pop("options")):
+            server_settings[name] = value
+    if server_settings:
+        connect_args["server_settings"] = server_settings
+    keep = {k: v for k, v in query.items() if k in ASYNCPG_URL_PARAMS}
+    dropped = sorted(set(url.query) - set(keep) - {"sslmode", "connect_timeout", "application_name", "options"})
+    if dropped:
+        print(f"Async engine: ignoring libpq-only URL parameters: {', '.join(dropped)}", file=sys.stderr)
+    return url.set(drivername="postgresql+asyncpg", query=keep), connect_args
+
+
 try:
     engine = create_engine(database_url)
     SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    # Async engine (asyncpg) for async endpoints, so DB waits don't block the event loop.
+    async_url, async_connect_args = asyncpg_url_and_args(make_url(database_url))
+    async_engine = create_async_engine(async_url, connect_args=async_connect_args, pool_size=20, max_overflow=20)
+    AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
     Base = declarative_base()
     print("Database connection configured successfully.", file=sys.stderr)
 except Exception as e:
@@ -26,12 +67,99 @@ except Exception as e:
     sys.exit(1)
 
 def init_db():
+    """Create missing tables (part of ensure_schema)."""
     try:
-        Base.metadata.create_all(bind=engine)
-        print("Tables initialized successfully.", file=sys.stderr)
+        # One catalog query instead of a has_table() round-trip per model
+        existing = set(inspect(engine).get_table_names())
+        missing = [t for t in Base.metadata.sorted_tables if t.name not in existing]
+        if missing:
+            Base.metadata.create_all(bind=engine, tables=missing, checkfirst=False)
+            print(f"Tables created: {', '.join(t.name for t in missing)}", file=sys.stderr)
+        else:
+            print("Tables already initialized.", file=sys.stderr)
     except Exception as e:
         print(f"Error initializing tables: {e}", file=sys.stderr)
 
+# Idempotent migrations for existing databases: (name, statements), run in order
+MIGRATIONS = [
+    ("cryptobot_invoice_id", [
+        "ALTER TABLE app_payments ADD COLUMN IF NOT EXISTS cryptobot_invoice_id VARCHAR UNIQUE",
+    ]),
+    ("max_pages", [
+        "ALTER TABLE app_users ADD COLUMN IF NOT EXISTS max_pages INTEGER",
+        "ALTER TABLE app_invite_codes ADD COLUMN IF NOT EXISTS max_pages INTEGER",
+    ]),
+    # Per-job LLM token usage on app_usages
+    ("usage tokens", [
+        """
+        ALTER TABLE app_usages
+        ADD COLUMN IF NOT EXISTS job_id INTEGER REFERENCES app_jobs(id),
+        ADD COLUMN IF NOT EXISTS model VARCHAR,
+        ADD COLUMN IF NOT EXISTS prompt_tokens INTEGER,
+        ADD COLUMN IF NOT EXISTS completion_tokens INTEGER
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_app_usages_job_id ON app_usages (job_id)",
+    ]),
+    # Worker claim/checkpoint time, used for stale detection
+    ("jobs updated_at", [
+        "ALTER TABLE app_jobs ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP",
+    ]),
+    # Worker claim + status counts filter on it
+    ("jobs status index", [
+        "CREATE INDEX IF NOT EXISTS ix_app_jobs_status ON app_jobs (status)",
+    ]),
+    # NOTIFY the worker (channel "jobs_new") whenever a job becomes queued
+    ("jobs notify", [
+        """
+        CREATE OR REPLACE FUNCTION app_jobs_notify() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('jobs_new', NEW.id::text);
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'app_jobs_notify') THEN
+                CREATE TRIGGER app_jobs_notify
+                AFTER INSERT OR UPDATE OF status ON app_jobs
+                FOR EACH ROW WHEN (NEW.status = 'queued')
+                EXECUTE FUNCTION app_jobs_notify();
+            END IF;
+        END
+        $$
+        """,
+    ]),
+]
+
+SCHEMA_LOCK_ID = 72610401  # pg_advisory_lock key: API and worker may start at the same time
+
+
+def ensure_schema():
+    """
+    Single entry point for schema setup, called by both the API and the worker on start:
+    missing tables, then MIGRATIONS. Serialized across processes with an advisory lock.
+    A failing migration is reported and skipped; failing to reach the DB raises.
+    """
+    with engine.connect() as conn:
+        conn.execute(text("SELECT pg_advisory_lock(:k)"), {"k": SCHEMA_LOCK_ID})
+        conn.commit()
+        try:
+            init_db()
+            for name, statements in MIGRATIONS:
+                try:
+                    for sql in statements:
+                        conn.execute(text(sql))
+                    conn.commit()
+                    print(f"Migration: {name} ready", file=sys.stderr)
+                except Exception as e:
+                    conn.rollback()
+                    print(f"Migration note ({name}): {e}", file=sys.stderr)
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": SCHEMA_LOCK_ID})
+            conn.commit()
+
 # --- 2. МОДЕЛИ (ТАБЛИЦЫ) ---
 
 class User(Base):
@@ -68,11 +196,12 @@ class Job(Base):
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("app_users.id")) # Ссылка на новое имя
     filename = Column(String)
-    status = Column(String, default="queued")
+    status = Column(String, default="queued", index=True)
     r2_key_input = Column(String)
     r2_key_output = Column(String, nullable=True)
     word_count = Column(Integer, default=0)
     created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, nullable=True)  # set by the worker on claim and at each checkpoint
 
     user = relationship("User", back_populates="jobs")
 
@@ -83,8 +212,22 @@ class Usage(Base):
     words_deducted = Column(Integer)
     timestamp = Column(DateTime, default=datetime.utcnow)
 
+    # LLM tokens a job actually spent, as reported by the provider (written by the worker)
+    job_id = Column(Integer, ForeignKey("app_jobs.id"), nullable=True, index=True)
+    model = Column(String, nullable=True)
+    prompt_tokens = Column(Integer, nullable=True)
+    completion_tokens = Column(Integer, nullable=True)
+
     user = relationship("User", back_populates="usages")
 
+class TranslationCache(Base):
+    """LLM translations keyed by a hash of (model, system prompt, chunk), shared by all workers"""
+    __tablename__ = "app_translation_cache"
+    key = Column(String, primary_key=True)
+    model = Column(String)
+    output = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
 
 # --- PAYMENT TRACKING ---
 
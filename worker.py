@@ -1,20 +1,36 @@
 import os
 import sys
 import time
-import gc
 import logging
 import traceback
 import asyncio
+import contextvars
+import functools
+import hashlib
+import random
+import re
+import tempfile
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Mapping
 from datetime import datetime, timedelta
 from uuid import uuid4
 
 import boto3
-import pdfplumber
 import aiohttp
+import orjson
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from boto3.s3.transfer import TransferConfig
 from botocore.client import Config
+from sqlalchemy import select, text, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import Session
 
-from models import SessionLocal, Job, User
+from models import SessionLocal, Job, User, Usage, TranslationCache, database_url, ensure_schema
 
 
 # ----------------------------
@@ -47,6 +63,8 @@ R2_BUCKET = os.getenv("R2_BUCKET")
 R2_ENDPOINT = os.getenv("R2_ENDPOINT")
 R2_ACCESS_KEY = os.getenv("R2_ACCESS_KEY")
 R2_SECRET_KEY = os.getenv("R2_SECRET_KEY")
+# Attempts per R2 request (each multipart part is retried on its own, not the whole object)
+R2_MAX_ATTEMPTS = int(os.getenv("R2_MAX_ATTEMPTS", "8"))
 
 # LLM Provider
 LLM_PROVIDER = os.getenv("LLM_PROVIDER", "deepseek")
@@ -58,17 +76,96 @@ ROUTELLM_API_KEY = os.getenv("ROUTELLM_API_KEY")
 ROUTELLM_URL = os.getenv("ROUTELLM_URL", "https://routellm.abacus.ai/v1/chat/completions")
 ROUTELLM_MODEL = os.getenv("ROUTELLM_MODEL", "gpt-4o-mini")
 
+
+@dataclass(frozen=True, slots=True)
+class LLMConfig:
+    """The active LLM provider, resolved once at import."""
+    name: str
+    key_env: str  # env var the key comes from (for env_sanity)
+    api_key: str
+    api_url: str
+    model: str
+    headers: Mapping[str, str]
+
+
+def load_llm_config() -> LLMConfig:
+    if LLM_PROVIDER == "deepseek":
+        name, key_env, api_key, api_url, model = (
+            "DeepSeek", "DEEPSEEK_API_KEY", DEEPSEEK_API_KEY, DEEPSEEK_URL, DEEPSEEK_MODEL
+        )
+    else:
+        name, key_env, api_key, api_url, model = (
+            "RouteLLM", "ROUTELLM_API_KEY", ROUTELLM_API_KEY, ROUTELLM_URL, ROUTELLM_MODEL
+        )
+    headers = MappingProxyType({
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+    })
+    return LLMConfig(name, key_env, api_key, api_url, model, headers)
+
+
+LLM = load_llm_config()
+
 POLL_SECONDS = int(os.getenv("WORKER_POLL_SECONDS", "5"))
+# Adaptive polling: back off while the queue is empty, snap back to MIN when a job shows up
+POLL_MIN_SECONDS = float(os.getenv("WORKER_POLL_MIN", "1"))
+POLL_MAX_SECONDS = float(os.getenv("WORKER_POLL_MAX", "60"))
+POLL_BACKOFF = float(os.getenv("WORKER_POLL_BACKOFF", "2"))
+# Channel the app_jobs trigger (see main.py startup) NOTIFYs on when a job becomes queued
+JOBS_CHANNEL = "jobs_new"
 PDF_BATCH_SIZE = int(os.getenv("PDF_BATCH_SIZE", "20"))
-CHECKPOINT_EVERY_PAGES = 1
+# Progress (job.word_count = pages done) is committed every N pages and at each batch end
+CHECKPOINT_COMMIT_EVERY = int(os.getenv("CHECKPOINT_COMMIT_EVERY", "25"))
+# ...or when the last commit is older than this, so progress on slow jobs doesn't look stuck
+CHECKPOINT_MAX_SECONDS = float(os.getenv("CHECKPOINT_MAX_SECONDS", "30"))
 
 LLM_TIMEOUT_SECONDS = int(os.getenv("LLM_TIMEOUT_SECONDS", "180"))
-LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+# Stream completions (SSE); a stream that goes quiet for LLM_STALL_SECONDS is dropped and retried
+LLM_STREAM = os.getenv("LLM_STREAM", "1") == "1"
+LLM_STALL_SECONDS = int(os.getenv("LLM_STALL_SECONDS", "60"))
+LLM_CLIENT_TIMEOUT = aiohttp.ClientTimeout(
+    total=LLM_TIMEOUT_SECONDS, sock_connect=10, sock_read=LLM_STALL_SECONDS if LLM_STREAM else None
+)
+# Deterministic by default: repeatable output, and cached translations stay valid
+LLM_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", "0"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "6"))
+# Upper bound on generated tokens per chunk; Russian output runs ~1.5x the English token count
+LLM_MAX_OUTPUT_TOKENS = int(os.getenv("LLM_MAX_OUTPUT_TOKENS", "8192"))
+LLM_BACKOFF_MAX_SECONDS = float(os.getenv("LLM_BACKOFF_MAX_SECONDS", "60"))
+LLM_RETRYABLE_STATUSES = {429, 500, 502, 503, 504, 529}
+# A 400 whose body says the input is too long for the model
+_CONTEXT_LENGTH_RE = re.compile(r"context[ _]length|context window|maximum context|too many tokens", re.IGNORECASE)
 MAX_CHARS_PER_CHUNK = int(os.getenv("MAX_CHARS_PER_CHUNK", "12000"))
+# A 'processing' job whose updated_at (set on claim, refreshed by every checkpoint) is
+# older than this is taken to have lost its worker and is claimed again
 STALE_PROCESSING_MINUTES = int(os.getenv("STALE_PROCESSING_MINUTES", "60"))
 
 # Concurrency limit
 MAX_CONCURRENT_JOBS = int(os.getenv("MAX_CONCURRENT_JOBS", "5"))
+# In-flight LLM requests across all jobs in this worker
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "8"))
+# Processes for CPU-bound PDF text extraction (shared by all jobs)
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", "2"))
+# Worker processes started by run_worker(), each a full worker (own event loop, DB pool,
+# extraction pool) claiming from the same queue
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "1"))
+# Recycle an extraction process after this many batches to hand back memory pdfminer
+# leaks (0 = never). Each recycle costs one reparse of the job's PDF.
+EXTRACT_MAX_TASKS_PER_CHILD = int(os.getenv("EXTRACT_MAX_TASKS_PER_CHILD", "0"))
+# PDFs up to this size are loaded into memory for PyMuPDF; larger ones are read from disk
+PDF_IN_MEMORY_MAX_BYTES = int(os.getenv("PDF_IN_MEMORY_MAX_BYTES", str(64 * 1024 * 1024)))
+# Plain-text uploads (no PDF header) are cut into pages of about this many chars, unless
+# they carry form feeds
+TEXT_PAGE_CHARS = int(os.getenv("TEXT_PAGE_CHARS", "3000"))
+# Job output is uploaded to R2 in parts of this size while translation is still running
+# (R2 wants equal-sized parts, >= 5 MiB, except the last)
+OUTPUT_PART_BYTES = max(int(os.getenv("OUTPUT_PART_BYTES", str(8 * 1024 * 1024))), 5 * 1024 * 1024)
+# Up to this many consecutive pages go in one LLM request (as long as they fit MAX_CHARS_PER_CHUNK)
+LLM_PAGE_BATCH = int(os.getenv("LLM_PAGE_BATCH", "4"))
+# Translations kept in memory for repeated chunks (headers, footers, boilerplate)
+TRANSLATION_CACHE_SIZE = int(os.getenv("TRANSLATION_CACHE_SIZE", "4096"))
+# ...and in app_translation_cache (shared, survives restarts) for this long
+TRANSLATION_CACHE_TTL_HOURS = int(os.getenv("TRANSLATION_CACHE_TTL_HOURS", "72"))
 
 CONTEXT_CHARS = int(os.getenv("CONTEXT_CHARS", "500"))
 
@@ -102,10 +199,42 @@ SYSTEM_PROMPT_WITH_CONTEXT = (
     "6. If the page starts with a partial sentence, translate it correctly based on previous context.\n"
     "7. If the page ends mid-sentence, use the next page preview to choose correct Russian word forms.\n"
     "8. Keep the original formatting, line breaks, and structure exactly as they are.\n"
-    "9. Output ONLY the translation of 'CURRENT PAGE TEXT'. Nothing more, nothing less."
+    "9. The text may contain page markers like <<<PAGE 12>>> on their own lines. "
+    "Copy every marker unchanged, on its own line and in the same order, and translate the text between them.\n"
+    "10. Output ONLY the translation of 'CURRENT PAGE TEXT'. Nothing more, nothing less."
 )
 
 
+
+def llm_body_template(system_prompt: str) -> tuple:
+    """
+    Request JSON split around the user message: (bytes before, bytes after).
+    Model, settings and the long system prompt are serialized once, not per call.
+    """
+    placeholder = "\x00USER\x00"
+    body = {
+        # System prompt first and byte-identical on every call: the provider's automatic
+        # prefix cache (DeepSeek, OpenAI-compatible) then serves its prefill
+        "model": LLM.model,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": placeholder},
+        ],
+        "temperature": LLM_TEMPERATURE,
+        "max_tokens": LLM_MAX_OUTPUT_TOKENS,
+        "stream": LLM_STREAM,
+    }
+    if LLM_STREAM:
+        body["stream_options"] = {"include_usage": True}  # final event carries token usage
+    raw = orjson.dumps(body)
+    before, after = raw.split(orjson.dumps(placeholder))
+    return before, after
+
+
+LLM_BODY = llm_body_template(SYSTEM_PROMPT)
+LLM_BODY_WITH_CONTEXT = llm_body_template(SYSTEM_PROMPT_WITH_CONTEXT)
+
+
 # ----------------------------
 # R2 client
 # ----------------------------
@@ -115,12 +244,82 @@ def make_s3():
         endpoint_url=R2_ENDPOINT,
         aws_access_key_id=R2_ACCESS_KEY,
         aws_secret_access_key=R2_SECRET_KEY,
-        config=Config(signature_version="s3v4"),
+        config=Config(signature_version="s3v4", retries={"max_attempts": R2_MAX_ATTEMPTS, "mode": "standard"}),
         region_name="auto",
     )
 
 
-s3 = make_s3()
+@functools.lru_cache(maxsize=1)
+def get_s3():
+    """Built on first use, so extraction processes (which import this module) never create one."""
+    return make_s3()
+
+# Multipart, concurrent transfers for large job inputs (R2 per-request latency is high)
+R2_TRANSFER_CONCURRENCY = int(os.getenv("R2_TRANSFER_CONCURRENCY", "16"))
+TRANSFER_CFG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=R2_TRANSFER_CONCURRENCY,
+    use_threads=True,
+)
+
+
+class OutputUpload:
+    """
+    Streams a job's output to R2 as it is written: every full OUTPUT_PART_BYTES
+    goes up as a multipart part in the background while translation continues.
+    Output that never fills a part is sent with a single put_object at the end.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.buf = bytearray()
+        self.upload_id = None
+        self.parts = []  # tasks -> {"PartNumber", "ETag"}
+
+    async def write(self, data: bytes):
+        self.buf += data
+        while len(self.buf) >= OUTPUT_PART_BYTES:
+            body = bytes(self.buf[:OUTPUT_PART_BYTES])
+            del self.buf[:OUTPUT_PART_BYTES]
+            await self._start_part(body)
+
+    async def _start_part(self, body: bytes):
+        if self.upload_id is None:
+            resp = await asyncio.to_thread(get_s3().create_multipart_upload, Bucket=R2_BUCKET, Key=self.key)
+            self.upload_id = resp["UploadId"]
+        self.parts.append(asyncio.create_task(self._upload_part(len(self.parts) + 1, body)))
+
+    async def _upload_part(self, part_no: int, body: bytes) -> dict:
+        resp = await asyncio.to_thread(
+            get_s3().upload_part,
+            Bucket=R2_BUCKET, Key=self.key, UploadId=self.upload_id, PartNumber=part_no, Body=body,
+        )
+        return {"PartNumber": part_no, "ETag": resp["ETag"]}
+
+    async def finish(self):
+        if self.upload_id is None:
+            await asyncio.to_thread(get_s3().put_object, Bucket=R2_BUCKET, Key=self.key, Body=bytes(self.buf))
+            return
+        if self.buf:
+            await self._start_part(bytes(self.buf))
+            self.buf.clear()
+        parts = await asyncio.gather(*self.parts)
+        await asyncio.to_thread(
+            get_s3().complete_multipart_upload,
+            Bucket=R2_BUCKET, Key=self.key, UploadId=self.upload_id, MultipartUpload={"Parts": parts},
+        )
+
+    async def abort(self):
+        if self.upload_id is None:
+            return
+        await asyncio.gather(*self.parts, return_exceptions=True)
+        try:
+            await asyncio.to_thread(
+                get_s3().abort_multipart_upload, Bucket=R2_BUCKET, Key=self.key, UploadId=self.upload_id
+            )
+        except Exception as e:
+            logger.warning(f"abort_multipart_upload failed for '{self.key}': {e}")
 
 
 def env_sanity():
@@ -134,12 +333,8 @@ def env_sanity():
         if not v:
             missing.append(k)
 
-    if LLM_PROVIDER == "deepseek":
-        if not DEEPSEEK_API_KEY:
-            missing.append("DEEPSEEK_API_KEY")
-    else:
-        if not ROUTELLM_API_KEY:
-            missing.append("ROUTELLM_API_KEY")
+    if not LLM.api_key:
+        missing.append(LLM.key_env)
 
     if missing:
         logger.error(f"Missing env vars: {', '.join(missing)}")
@@ -149,29 +344,243 @@ def env_sanity():
     return True
 
 
+# ----------------------------
+# PDF extraction (process pool)
+# ----------------------------
+# PyMuPDF (C) does the extraction when available; pdfplumber is the fallback.
+# Either way it's CPU-bound and holds the GIL, so it runs in separate processes
+# while the event loop keeps LLM requests in flight.
+_extract_pool = None
+_extract_pool_users = 0  # jobs currently running; the pool is shut down when this drops to 0
+
+# Per-process cache of open documents: a job's batches are parsed once per
+# process, not once per batch. Small, since each entry pins a parsed PDF.
+# Entries die with their job: a finished job's temp file is gone (see _drop_finished_pdfs),
+# and an idle worker shuts the pool's processes down (see release_extract_pool).
+_open_pdfs: OrderedDict = OrderedDict()
+_OPEN_PDFS_MAX = 3
+
+
+def get_extract_pool() -> ProcessPoolExecutor:
+    global _extract_pool
+    if _extract_pool is None:
+        # spawn, not fork: the parent has live DB connections and threads
+        kwargs = {}
+        if EXTRACT_MAX_TASKS_PER_CHILD > 0:
+            kwargs["max_tasks_per_child"] = EXTRACT_MAX_TASKS_PER_CHILD  # Python 3.11+
+        _extract_pool = ProcessPoolExecutor(
+            max_workers=EXTRACT_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            **kwargs,
+        )
+    return _extract_pool
+
+
+def acquire_extract_pool():
+    global _extract_pool_users
+    _extract_pool_users += 1
+
+
+def release_extract_pool():
+    """
+    A job is done with the pool. When it was the last one, shut the pool down: its
+    processes would otherwise keep the finished jobs' parsed PDFs (in-memory copies
+    of up to PDF_IN_MEMORY_MAX_BYTES each) while the worker sits idle.
+    """
+    global _extract_pool, _extract_pool_users
+    _extract_pool_users -= 1
+    if _extract_pool_users == 0 and _extract_pool is not None:
+        _extract_pool.shutdown(wait=False, cancel_futures=True)
+        _extract_pool = None
+
+
+def _drop_finished_pdfs():
+    """Close cached documents whose file was removed, i.e. whose job has finished."""
+    for key in [k for k in _open_pdfs if not os.path.exists(k[1] if isinstance(k, tuple) else k)]:
+        _open_pdfs.pop(key)[0].close()
+
+
+def _open_pdf(path: str):
+    """(doc, is_mupdf) for path, from the per-process cache."""
+    _drop_finished_pdfs()
+    entry = _open_pdfs.get(path)
+    if entry is not None:
+        _open_pdfs.move_to_end(path)
+        return entry
+
+    entry = None
+    try:
+        import fitz  # PyMuPDF: raw text only, no layout analysis
+
+        if os.path.getsize(path) <= PDF_IN_MEMORY_MAX_BYTES:
+            # Parse from memory: xref/page lookups don't go through file reads, and the
+            # cached document doesn't pin the job's temp file after it's deleted
+            with open(path, "rb") as f:
+                entry = (fitz.open(stream=f.read(), filetype="pdf"), True)
+        else:
+            entry = (fitz.open(path), True)
+    except ImportError:
+        pass
+    except Exception as e:
+        logger.warning(f"PyMuPDF can't open '{path}', falling back to pdfplumber: {e}")
+    if entry is None:
+        import pdfplumber  # heavy (pdfminer); only the extraction processes need it
+
+        entry = (pdfplumber.open(path), False)
+
+    _open_pdfs[path] = entry
+    while len(_open_pdfs) > _OPEN_PDFS_MAX:
+        _, (old, _) = _open_pdfs.popitem(last=False)
+        old.close()
+    return entry
+
+
+def _open_plumber(path: str):
+    """pdfplumber handle for path, from the same per-process cache (PyMuPDF text fallback)."""
+    key = ("plumber", path)
+    entry = _open_pdfs.get(key)
+    if entry is not None:
+        _open_pdfs.move_to_end(key)
+        return entry[0]
+
+    import pdfplumber
+
+    entry = (pdfplumber.open(path), False)
+    _open_pdfs[key] = entry
+    while len(_open_pdfs) > _OPEN_PDFS_MAX:
+        _, (old, _) = _open_pdfs.popitem(last=False)
+        old.close()
+    return entry[0]
+
+
+def pdf_page_count(path: str) -> int:
+    doc, is_mupdf = _open_pdf(path)
+    return doc.page_count if is_mupdf else len(doc.pages)
+
+
+def _plumber_page_text(pdf, i: int) -> str:
+    page = pdf.pages[i]
+    text = page.extract_text() or ""
+    page.flush_cache()  # drop parsed layout objects, keep memory flat
+    return text
+
+
+def extract_page_texts(path: str, start: int, stop: int) -> list:
+    """Text of pages [start, stop); runs in the extraction pool."""
+    doc, is_mupdf = _open_pdf(path)
+    texts = []
+    for i in range(start, stop):
+        try:
+            if is_mupdf:
+                text = doc.load_page(i).get_text("text")
+                if not text.strip():
+                    # Opened on first need and kept, like doc, for the job's later batches
+                    text = _plumber_page_text(_open_plumber(path), i)
+            else:
+                text = _plumber_page_text(doc, i)
+        except Exception as e:
+            logger.warning(f"extract_text failed page {i+1} of '{path}': {e}")
+            text = ""
+        texts.append(text)
+    return texts
+
+
+# ----------------------------
+# Plain-text input
+# ----------------------------
+def is_pdf_file(path: str) -> bool:
+    """PDF header in the first 1 KiB (readers tolerate junk before it, so we do too)."""
+    with open(path, "rb") as f:
+        return b"%PDF-" in f.read(1024)
+
+
+def read_text_pages(path: str):
+    """Pages of a UTF-8 text upload, or None if it isn't text. No parser involved."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if b"\x00" in data:
+        return None  # binary (zip/epub, images, ...)
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return None
+    if "\f" in text:
+        return text.split("\f")
+    return chunk_text_preserving_lines(text, TEXT_PAGE_CHARS) if text else []
+
+
 # ----------------------------
 # Text chunking helpers
 # ----------------------------
 def chunk_text_preserving_lines(text: str, max_chars: int):
-    lines = text.splitlines(keepends=True)
+    if len(text) <= max_chars:
+        return [text]
+
+    # Walk line ends by index and slice each chunk out once: no per-line strings
     chunks = []
-    buf = ""
-    for line in lines:
-        if len(buf) + len(line) > max_chars and buf:
-            chunks.append(buf)
-            buf = ""
-        buf += line
-    if buf:
-        chunks.append(buf)
+    start = 0  # start of the current chunk
+    pos = 0    # end of the last whole line in it
+    n = len(text)
+    while pos < n:
+        nl = text.find("\n", pos)
+        end = n if nl == -1 else nl + 1
+        if end - start > max_chars and pos > start:
+            chunks.append(text[start:pos])
+            start = pos
+        pos = end
+    if start < n:
+        chunks.append(text[start:])
+    # Only a single line can still be over the limit (reflowed paragraphs, extraction
+    # without line breaks); split those so no request outgrows the model's window
+    if any(len(ch) > max_chars for ch in chunks):
+        chunks = [piece for ch in chunks for piece in split_long_line(ch, max_chars)]
     return chunks
 
 
+_SENTENCE_ENDS = (". ", "! ", "? ", "… ")
+
+
+def split_long_line(line: str, max_chars: int) -> list:
+    """Cut a line into pieces of at most max_chars: after a sentence end if there is one
+    in the back half of the window, else after a space, else hard at max_chars."""
+    pieces = []
+    start = 0
+    n = len(line)
+    while n - start > max_chars:
+        lo, hi = start + max_chars // 2, start + max_chars - 1
+        cut = max(line.rfind(end, lo, hi + 1) for end in _SENTENCE_ENDS)
+        if cut == -1:
+            cut = line.rfind(" ", lo, hi)
+        cut = start + max_chars if cut == -1 else cut + (2 if line[cut] != " " else 1)
+        pieces.append(line[start:cut])
+        start = cut
+    pieces.append(line[start:])
+    return pieces
+
+
+_LATIN_LETTER_RE = re.compile(r"[A-Za-z]")
+_CYRILLIC_LETTER_RE = re.compile(r"[\u0400-\u04FF]")
+
+
+def needs_translation(text: str) -> bool:
+    """
+    False for text with nothing to send to the LLM: no Latin words at all (page
+    numbers, dot-leader ToC lines, symbols) or mostly Cyrillic already.
+    """
+    latin = len(_LATIN_LETTER_RE.findall(text))
+    if latin < 2:
+        return False
+    cyrillic = len(_CYRILLIC_LETTER_RE.findall(text))
+    return cyrillic <= latin
+
+
 def get_page_tail(text: str, max_chars: int = CONTEXT_CHARS) -> str:
     if not text or len(text) <= max_chars:
         return text
     tail = text[-max_chars:]
-    space_idx = tail.find(' ')
-    if space_idx > 0 and space_idx < len(tail) // 2:
+    # Drop the partial first word; only look for a space in the first half
+    space_idx = tail.find(' ', 0, len(tail) // 2)
+    if space_idx > 0:
         tail = tail[space_idx + 1:]
     return tail.strip()
 
@@ -180,8 +589,9 @@ def get_page_head(text: str, max_chars: int = 200) -> str:
     if not text or len(text) <= max_chars:
         return text
     head = text[:max_chars]
-    space_idx = head.rfind(' ')
-    if space_idx > len(head) // 2:
+    # Drop the partial last word; only look for a space in the second half
+    space_idx = head.rfind(' ', len(head) // 2 + 1)
+    if space_idx > 0:
         head = head[:space_idx]
     return head.strip()
 
@@ -189,32 +599,105 @@ def get_page_head(text: str, max_chars: int = 200) -> str:
 # ----------------------------
 # Async LLM call with aiohttp
 # ----------------------------
+llm_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+
+# LLM stats of the current job (new_llm_stats()): set in process_job_async, inherited by
+# every task the job starts, added to by each LLM reply (cache hits cost nothing)
+job_llm_stats: contextvars.ContextVar = contextvars.ContextVar("job_llm_stats", default=None)
+
+
+class LLMTranslationError(RuntimeError):
+    """The LLM gave no usable reply after all retries; fails the job instead of leaving English in the output."""
+
+
+def new_llm_stats() -> dict:
+    # chunks: LLM requests answered; incomplete: of those, not a full translation
+    return {"prompt_tokens": 0, "completion_tokens": 0, "chunks": 0, "incomplete": 0}
+
+
+def llm_input_rejected(status: int, body: str) -> bool:
+    """
+    The provider refused this particular chunk (too large), so it can stay untranslated
+    while the job goes on. Any other 4xx (bad request shape, unknown model, 401 key,
+    402 balance, ...) hits every request alike and must fail the job.
+    """
+    return status == 413 or (status == 400 and bool(_CONTEXT_LENGTH_RE.search(body)))
+
+
+def check_llm_stats(stats: dict):
+    """Fail a job whose every LLM reply was rejected or truncated: its output would be English."""
+    if stats["chunks"] and stats["incomplete"] == stats["chunks"]:
+        raise LLMTranslationError(
+            f"all {stats['chunks']} LLM requests were rejected or truncated; nothing was translated"
+        )
+
+
+def llm_retry_delay(attempt: int, err: Exception) -> float:
+    """Exponential backoff with jitter; a 429 Retry-After from the provider wins."""
+    if isinstance(err, aiohttp.ClientResponseError) and err.status == 429 and err.headers:
+        retry_after = err.headers.get("Retry-After")
+        if retry_after:
+            try:
+                return min(float(retry_after), LLM_BACKOFF_MAX_SECONDS)
+            except ValueError:
+                pass  # HTTP-date form, fall back to backoff
+    return min(2 ** attempt + random.uniform(0, 2), LLM_BACKOFF_MAX_SECONDS)
+
+
+def make_llm_session() -> aiohttp.ClientSession:
+    """One pooled session for all jobs, so keep-alive TLS connections are reused."""
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=LLM_CONCURRENCY * 2,
+            keepalive_timeout=60,  # outlive the gaps between batches, so TLS isn't redone per batch
+            ttl_dns_cache=300,
+            enable_cleanup_closed=True,  # reap TLS transports the server closed uncleanly
+        ),
+        headers=LLM.headers,
+    )
+
+
+async def prewarm_connections(session: aiohttp.ClientSession):
+    """
+    Open keep-alive connections to the LLM provider and R2 ahead of the first job,
+    so it doesn't pay DNS + TCP + TLS setup. Best effort: failures are only logged.
+    """
+    async def head_llm():
+        # Any status will do (chat endpoints usually answer HEAD with 404/405);
+        # the point is the pooled TLS connection left behind
+        async with session.head(LLM.api_url, timeout=aiohttp.ClientTimeout(total=10)) as resp:
+            return resp.status
+
+    results = await asyncio.gather(
+        *[head_llm() for _ in range(min(4, LLM_CONCURRENCY))],
+        asyncio.to_thread(get_s3().head_bucket, Bucket=R2_BUCKET),
+        return_exceptions=True,
+    )
+    errors = [r for r in results if isinstance(r, Exception)]
+    if errors:
+        logger.warning(f"Connection pre-warm incomplete ({len(errors)}/{len(results)} failed): {errors[0]!r}")
+    else:
+        logger.info(f"Connections pre-warmed (LLM x{len(results) - 1}, R2)")
+
+
 async def translate_chunk_async(
     session: aiohttp.ClientSession,
     chunk: str,
     req_id: str,
     context: str = None,
-    lookahead: str = None
-) -> str:
-    """Async translation using aiohttp."""
+    lookahead: str = None,
+    marked_pages: bool = False
+) -> tuple:
+    """
+    Async translation using aiohttp. marked_pages: chunk holds <<<PAGE n>>> markers to keep.
+    Returns (text, complete); complete is False when the text is not a full translation
+    (input rejected and handed back as is, or reply cut off at max_tokens).
+    """
     if not chunk or len(chunk.strip()) < 5:
-        return ""
-
-    if LLM_PROVIDER == "deepseek":
-        api_key = DEEPSEEK_API_KEY
-        api_url = DEEPSEEK_URL
-        model = DEEPSEEK_MODEL
-    else:
-        api_key = ROUTELLM_API_KEY
-        api_url = ROUTELLM_URL
-        model = ROUTELLM_MODEL
+        return "", False
 
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-    }
-
-    has_context = context or lookahead
+    # The marker rule lives in the context prompt
+    has_context = context or lookahead or marked_pages
 
     if has_context:
         parts = []
@@ -236,52 +719,254 @@ async def translate_chunk_async(
                 f"[END NEXT PAGE PREVIEW]"
             )
         user_message = "\n".join(parts)
-        system_prompt = SYSTEM_PROMPT_WITH_CONTEXT
+        before, after = LLM_BODY_WITH_CONTEXT
     else:
         user_message = chunk
-        system_prompt = SYSTEM_PROMPT
+        before, after = LLM_BODY
 
-    payload = {
-        "model": model,
-        "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_message},
-        ],
-        "temperature": 0.3,
-    }
+    # Only the user message is serialized per call; retries resend the same bytes
+    body = before + orjson.dumps(user_message) + after
 
     last_err = None
     for attempt in range(1, LLM_MAX_RETRIES + 1):
         try:
             t0 = time.time()
-            timeout = aiohttp.ClientTimeout(total=LLM_TIMEOUT_SECONDS)
-
-            async with session.post(api_url, headers=headers, json=payload, timeout=timeout) as resp:
-                dt = time.time() - t0
 
-                if resp.status != 200:
-                    text = await resp.text()
-                    logger.warning(
-                        f"[{req_id}] LLM HTTP {resp.status} (attempt {attempt}/{LLM_MAX_RETRIES}) "
-                        f"in {dt:.2f}s: {text[:4000]}"
-                    )
-                    raise aiohttp.ClientResponseError(
-                        resp.request_info, resp.history, status=resp.status
+            async with llm_semaphore:
+                async with session.post(LLM.api_url, data=body, timeout=LLM_CLIENT_TIMEOUT) as resp:
+                    dt = time.time() - t0
+
+                    if resp.status != 200:
+                        text = await resp.text()
+                        logger.warning(
+                            f"[{req_id}] LLM HTTP {resp.status} (attempt {attempt}/{LLM_MAX_RETRIES}) "
+                            f"in {dt:.2f}s: {text[:4000]}"
+                        )
+                        if llm_input_rejected(resp.status, text):
+                            # This input was refused - retrying won't help, other chunks may still go through
+                            logger.error(f"[{req_id}] LLM HTTP {resp.status} rejected the input; returning original chunk.")
+                            count_llm_reply(complete=False)
+                            return chunk, False
+                        if resp.status not in LLM_RETRYABLE_STATUSES:
+                            # Request/account problem (bad params, auth, balance, ...) - every page would fail the same way
+                            raise LLMTranslationError(f"LLM HTTP {resp.status} for {req_id}: {text[:500]}")
+                        raise aiohttp.ClientResponseError(
+                            resp.request_info, resp.history, status=resp.status, headers=resp.headers
+                        )
+
+                    if LLM_STREAM:
+                        out, finish_reason, usage = await read_sse_completion(resp)
+                    else:
+                        data = orjson.loads(await resp.read())
+                        choice = data["choices"][0]
+                        out, finish_reason = choice["message"]["content"], choice.get("finish_reason")
+                        usage = data.get("usage")
+                    count_llm_reply(finish_reason != "length", usage)
+                    if finish_reason == "length":
+                        logger.warning(f"[{req_id}] LLM output hit max_tokens={LLM_MAX_OUTPUT_TOKENS}; translation is truncated")
+                    logger.info(
+                        f"[{req_id}] LLM ok ({LLM_PROVIDER}/{LLM.model}) in {time.time() - t0:.2f}s "
+                        f"(first byte {dt:.2f}s, chars_in={len(chunk)}, chars_out={len(out)}{format_usage(usage)})"
                     )
+                    return out, finish_reason != "length"
 
-                data = await resp.json()
-                out = data["choices"][0]["message"]["content"]
-                logger.info(f"[{req_id}] LLM ok ({LLM_PROVIDER}/{model}) in {dt:.2f}s (chars_in={len(chunk)}, chars_out={len(out)})")
-                return out
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            last_err = e
+            logger.warning(f"[{req_id}] LLM error (attempt {attempt}/{LLM_MAX_RETRIES}): {e!r}")
+            if attempt < LLM_MAX_RETRIES:
+                await asyncio.sleep(llm_retry_delay(attempt, e))
 
-        except Exception as e:
+        except (KeyError, IndexError, orjson.JSONDecodeError) as e:
+            # 200 with a malformed body (no choices, cut-off JSON): retried like a transport error
             last_err = e
-            logger.warning(f"[{req_id}] LLM error (attempt {attempt}/{LLM_MAX_RETRIES}): {e}")
+            logger.warning(f"[{req_id}] LLM malformed reply (attempt {attempt}/{LLM_MAX_RETRIES}): {e!r}")
             if attempt < LLM_MAX_RETRIES:
-                await asyncio.sleep(1.5 * attempt)
+                await asyncio.sleep(llm_retry_delay(attempt, e))
+
+        except LLMTranslationError:
+            raise
+
+        except Exception as e:
+            # Anything else is a bug here, not a provider hiccup: don't retry it
+            last_err = e
+            logger.error(f"[{req_id}] LLM unexpected error: {e!r}")
+            break
+
+    logger.error(f"[{req_id}] LLM failed after retries. Last error: {last_err!r}")
+    raise LLMTranslationError(f"LLM failed for {req_id}: {last_err!r}") from last_err
+
+
+def count_llm_reply(complete: bool, usage: dict = None):
+    """Add one LLM reply to the current job's stats (no-op outside a job)."""
+    stats = job_llm_stats.get()
+    if stats is None:
+        return
+    stats["chunks"] += 1
+    if not complete:
+        stats["incomplete"] += 1
+    if usage:
+        stats["prompt_tokens"] += usage.get("prompt_tokens") or 0
+        stats["completion_tokens"] += usage.get("completion_tokens") or 0
+
+
+async def read_sse_completion(resp: aiohttp.ClientResponse) -> tuple:
+    """
+    Collect a streamed chat completion: (content, finish_reason, usage or None).
+    An error event, or a stream that ends before any finish_reason, raises
+    ClientPayloadError so the caller retries instead of keeping a partial reply.
+    """
+    parts = []
+    finish_reason = None
+    usage = None
+    async for line in resp.content:  # one SSE line at a time
+        line = line.strip()
+        if not line.startswith(b"data:"):
+            continue  # blank separators, ": keep-alive" comments
+        data = line[5:].strip()
+        if data == b"[DONE]":
+            break
+        event = orjson.loads(data)
+        if event.get("error"):
+            raise aiohttp.ClientPayloadError(f"LLM stream error event: {event['error']}")
+        usage = event.get("usage") or usage
+        choices = event.get("choices")
+        if not choices:
+            continue  # e.g. the trailing usage-only event
+        content = (choices[0].get("delta") or {}).get("content")
+        if content:
+            parts.append(content)
+        finish_reason = choices[0].get("finish_reason") or finish_reason
+    if finish_reason is None:
+        raise aiohttp.ClientPayloadError(f"LLM stream ended without finish_reason after {sum(map(len, parts))} chars")
+    return "".join(parts), finish_reason, usage
+
+
+def cached_prompt_tokens(usage: dict) -> int:
+    """Prompt tokens served from the provider's prefix cache (DeepSeek and OpenAI report it differently)."""
+    if "prompt_cache_hit_tokens" in usage:
+        return usage["prompt_cache_hit_tokens"] or 0
+    return (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+
+
+def format_usage(usage) -> str:
+    if not usage:
+        return ""
+    return (
+        f", tokens_in={usage.get('prompt_tokens')} (cached {cached_prompt_tokens(usage)})"
+        f", tokens_out={usage.get('completion_tokens')}"
+    )
+
+
+_translation_cache: OrderedDict = OrderedDict()
+
+
+def translation_cache_key(chunk: str, with_context: bool) -> str:
+    """Digest of (model, system prompt, chunk); context/lookahead only nudge word forms."""
+    system_prompt = SYSTEM_PROMPT_WITH_CONTEXT if with_context else SYSTEM_PROMPT
+    h = hashlib.blake2b(digest_size=16)
+    for part in (LLM.model, system_prompt, chunk):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def load_cached_translation(key: str):
+    cutoff = datetime.utcnow() - timedelta(hours=TRANSLATION_CACHE_TTL_HOURS)
+    db = SessionLocal()
+    try:
+        return db.execute(
+            select(TranslationCache.output)
+            .where(TranslationCache.key == key, TranslationCache.created_at >= cutoff)
+        ).scalar()
+    finally:
+        db.close()
+
+
+def store_cached_translation(key: str, output: str):
+    stmt = pg_insert(TranslationCache).values(
+        key=key, model=LLM.model, output=output, created_at=datetime.utcnow()
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[TranslationCache.key],
+        set_={"output": stmt.excluded.output, "created_at": stmt.excluded.created_at},
+    )
+    db = SessionLocal()
+    try:
+        db.execute(stmt)
+        db.commit()
+    finally:
+        db.close()
+
+
+def prune_translation_cache(db: Session):
+    cutoff = datetime.utcnow() - timedelta(hours=TRANSLATION_CACHE_TTL_HOURS)
+    try:
+        db.execute(text("DELETE FROM app_translation_cache WHERE created_at < :cutoff"), {"cutoff": cutoff})
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        logger.warning(f"Translation cache prune failed: {e}")
+
+
+async def translate_chunk_cached(
+    session: aiohttp.ClientSession,
+    chunk: str,
+    req_id: str,
+    context: str = None,
+    lookahead: str = None,
+    marked_pages: bool = False,
+    accept=None
+) -> str:
+    """
+    translate_chunk_async behind the in-process LRU and the shared DB cache.
+    accept(out) -> bool: extra check a fresh reply must pass to be cached.
+    """
+    key = translation_cache_key(chunk, bool(context or lookahead or marked_pages))
+    cached = _translation_cache.get(key)
+    if cached is not None:
+        _translation_cache.move_to_end(key)
+        logger.info(f"[{req_id}] translation cache hit (chars={len(chunk)})")
+        return cached
+
+    try:
+        cached = await asyncio.to_thread(load_cached_translation, key)
+    except Exception as e:
+        logger.warning(f"[{req_id}] translation cache lookup failed: {e}")
+    if cached is not None:
+        logger.info(f"[{req_id}] translation cache hit, db (chars={len(chunk)})")
+        out = cached
+    else:
+        out, complete = await translate_chunk_async(
+            session, chunk, req_id, context=context, lookahead=lookahead, marked_pages=marked_pages
+        )
+        # Only full, usable translations are cached: not a rejected chunk handed back as is,
+        # not a reply cut off at max_tokens, not one the caller can't use
+        if not out or not complete or (accept is not None and not accept(out)):
+            return out
+        try:
+            await asyncio.to_thread(store_cached_translation, key, out)
+        except Exception as e:
+            logger.warning(f"[{req_id}] translation cache store failed: {e}")
 
-    logger.error(f"[{req_id}] LLM failed after retries; returning original chunk. Last error: {last_err}")
-    return chunk
+    _translation_cache[key] = out
+    while len(_translation_cache) > TRANSLATION_CACHE_SIZE:
+        _translation_cache.popitem(last=False)
+    return out
+
+
+async def gather_or_cancel(*aws) -> list:
+    """
+    asyncio.gather(), except that the first failure cancels the others: once one chunk
+    has failed the job, its siblings stop instead of billing tokens for nothing.
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
 
 
 async def translate_text_async(
@@ -292,84 +977,186 @@ async def translate_text_async(
     lookahead: str = None
 ) -> str:
     """Translate text with optional context, using async HTTP."""
-    chunks = chunk_text_preserving_lines(text, MAX_CHARS_PER_CHUNK)
+    if not needs_translation(text):
+        return text
+
+    chunks = []
+    for ch in chunk_text_preserving_lines(text, MAX_CHARS_PER_CHUNK):
+        if not ch.strip():
+            continue  # whitespace-only: translate_chunk_async would return "" anyway
+        # Dropping blank chunks can leave neighbours that fit together; send one fuller request
+        if chunks and len(chunks[-1]) + len(ch) <= MAX_CHARS_PER_CHUNK:
+            chunks[-1] += ch
+        else:
+            chunks.append(ch)
+    if not chunks:
+        return ""
     if len(chunks) == 1:
-        return await translate_chunk_async(session, chunks[0], req_id, context=context, lookahead=lookahead)
+        return await translate_chunk_cached(session, chunks[0], req_id, context=context, lookahead=lookahead)
+
+    # Chunks are independent (context only on the first, lookahead only on the last),
+    # so translate them concurrently; results keep the original order.
+    # Total in-flight requests are capped by llm_semaphore.
+    n = len(chunks)
+    out_parts = await gather_or_cancel(*(
+        translate_chunk_cached(
+            session, ch, f"{req_id}.c{idx}/{n}",
+            context=context if idx == 1 else None,
+            lookahead=lookahead if idx == n else None,
+        )
+        for idx, ch in enumerate(chunks, start=1)
+    ))
+    # Replies come back stripped; restore the line break / space each chunk ended with
+    # so neighbouring chunks don't run together
+    return "".join(
+        out if not out or out[-1].isspace() else out + ch[len(ch.rstrip()):]
+        for ch, out in zip(chunks, out_parts)
+    )
 
-    out_parts = []
-    for idx, ch in enumerate(chunks, start=1):
-        part_id = f"{req_id}.c{idx}/{len(chunks)}"
-        chunk_context = context if idx == 1 else None
-        chunk_lookahead = lookahead if idx == len(chunks) else None
-        result = await translate_chunk_async(session, ch, part_id, context=chunk_context, lookahead=chunk_lookahead)
-        out_parts.append(result)
-    return "".join(out_parts)
 
+PAGE_MARKER_RE = re.compile(r"^<<<PAGE (\d+)>>>[ \t]*$", re.MULTILINE)
+
+
+def group_pages(texts: list, max_pages: int, max_chars: int) -> list:
+    """
+    Split page indexes into runs translated by one request each: blank and
+    untranslatable pages stand alone, others are packed up to max_pages /
+    max_chars per run.
+    """
+    groups = []
+    group_chars = 0
+    translatable = [bool(t.strip()) and needs_translation(t) for t in texts]
+    for k, t in enumerate(texts):
+        if (
+            groups and translatable[k] and translatable[groups[-1][-1]]
+            and len(groups[-1]) < max_pages
+            and group_chars + len(t) <= max_chars
+        ):
+            groups[-1].append(k)
+            group_chars += len(t)
+        else:
+            groups.append([k])
+            group_chars = len(t)
+    return groups
+
+
+def split_marked_pages(out: str, page_nos: list):
+    """Per-page texts of a <<<PAGE n>>>-marked reply, or None if its markers aren't exactly page_nos."""
+    parts = PAGE_MARKER_RE.split(out)  # [preamble, n1, text1, n2, text2, ...]
+    if [int(n) for n in parts[1::2]] != page_nos or parts[0].strip():
+        return None
+    return [p.strip("\n") for p in parts[2::2]]
 
-# ----------------------------
-# Job claiming (sync, runs in thread)
-# ----------------------------
-def requeue_stale_processing(db: Session, active_job_ids: set = None):
-    """Requeue jobs stuck in 'processing' too long, but skip actively running jobs."""
-    if active_job_ids is None:
-        active_job_ids = set()
-    try:
-        cutoff = datetime.utcnow() - timedelta(minutes=STALE_PROCESSING_MINUTES)
-        ts_field = None
-        if hasattr(Job, "updated_at"):
-            ts_field = Job.updated_at
-        elif hasattr(Job, "created_at"):
-            ts_field = Job.created_at
-
-        if ts_field is None:
-            return
 
-        stale_jobs = (
-            db.query(Job)
-            .filter(Job.status == "processing", ts_field < cutoff)
-            .order_by(ts_field.asc())
-            .all()
+async def translate_pages_batched(
+    session: aiohttp.ClientSession,
+    pages: list,
+    req_id: str,
+    context: str = None,
+    lookahead: str = None
+) -> list:
+    """
+    Translate consecutive (page_no, text) pages in one request, with <<<PAGE n>>>
+    markers between them. Returns one translation per page; if the reply's markers
+    don't line up, the pages are retranslated one request each.
+    """
+    if len(pages) == 1:
+        return [await translate_text_async(session, pages[0][1], req_id, context=context, lookahead=lookahead)]
+
+    page_nos = [page_no for page_no, _ in pages]
+    marked = "\n".join(f"<<<PAGE {page_no}>>>\n{text}" for page_no, text in pages)
+    out = await translate_chunk_cached(
+        session, marked, req_id, context=context, lookahead=lookahead, marked_pages=True,
+        accept=lambda reply: split_marked_pages(reply, page_nos) is not None,
+    )
+
+    translated = split_marked_pages(out, page_nos)
+    if translated is not None:
+        return translated
+
+    logger.warning(f"[{req_id}] page markers don't match in batched reply; translating pages one by one")
+    n = len(pages)
+    return list(await gather_or_cancel(*(
+        translate_text_async(
+            session, text, f"{req_id}.p{page_no}",
+            context=context if idx == 0 else get_page_tail(pages[idx - 1][1], CONTEXT_CHARS),
+            lookahead=lookahead if idx == n - 1 else get_page_head(pages[idx + 1][1], 200),
         )
+        for idx, (page_no, text) in enumerate(pages)
+    )))
 
-        for stale in stale_jobs:
-            # Skip jobs that are actively being processed by our async tasks
-            if stale.id in active_job_ids:
-                continue
-            logger.warning(f"[job {stale.id}] Re-queuing stale processing job (older than {STALE_PROCESSING_MINUTES}m)")
-            stale.status = "queued"
-            db.commit()
 
-    except Exception as e:
-        logger.warning(f"Stale requeue check failed: {e}")
+# ----------------------------
+# Job claiming
+# ----------------------------
+# One round trip: claim the oldest queued job, or a 'processing' one whose worker
+# died (no claim or checkpoint since the stale cutoff), skipping jobs this worker is
+# running itself. Rows claimed before updated_at existed fall back to created_at.
+CLAIM_JOB_SQL = text("""
+    UPDATE app_jobs AS j
+    SET status = 'processing', updated_at = :now
+    FROM (
+        SELECT id, status
+        FROM app_jobs
+        WHERE (
+            status = 'queued'
+            OR (status = 'processing' AND COALESCE(updated_at, created_at) < :cutoff)
+        )
+          AND NOT (id = ANY(CAST(:active_ids AS INTEGER[])))
+        ORDER BY created_at ASC
+        FOR UPDATE SKIP LOCKED
+        LIMIT 1
+    ) AS prev
+    WHERE j.id = prev.id
+    RETURNING j.id, prev.status AS prev_status
+""")
+
+
+def claim_next_job(db: Session, active_job_ids: set = None):
+    """Claim the next job and return its id, or None if nothing is available."""
+    now = datetime.utcnow()
+    cutoff = now - timedelta(minutes=STALE_PROCESSING_MINUTES)
+    row = db.execute(
+        CLAIM_JOB_SQL, {"now": now, "cutoff": cutoff, "active_ids": list(active_job_ids or ())}
+    ).mappings().first()
+    db.commit()
 
+    if not row:
+        return None
+    if row["prev_status"] == "processing":
+        logger.warning(f"[job {row['id']}] Re-claiming stale processing job (no progress for {STALE_PROCESSING_MINUTES}m)")
+    return row["id"]
 
-def claim_next_job(db: Session):
-    """Claim oldest queued job. Returns None if no jobs available."""
-    q = db.query(Job).filter(Job.status == "queued").order_by(Job.created_at.asc())
 
-    job = None
-    try:
-        job = q.with_for_update(skip_locked=True).first()
-    except Exception:
-        job = q.first()
+def set_job_fields(db: Session, job_id: int, **values):
+    """UPDATE just these columns and commit (no ORM load or dirty tracking).
+    Also refreshes updated_at, which keeps a running job from looking stale."""
+    db.execute(update(Job).where(Job.id == job_id).values(updated_at=datetime.utcnow(), **values))
+    db.commit()
 
-    if not job:
-        return None
 
-    job.status = "processing"
+def record_token_usage(db: Session, job: Job, tokens: dict):
+    """One app_usages row with the LLM tokens a job spent."""
+    db.add(Usage(
+        user_id=job.user_id,
+        job_id=job.id,
+        model=LLM.model,
+        prompt_tokens=tokens["prompt_tokens"],
+        completion_tokens=tokens["completion_tokens"],
+    ))
     db.commit()
-    db.refresh(job)
-    return job
 
 
 def get_job_counts(db: Session):
     """Get counts of jobs by status."""
     try:
-        q = db.query(Job).filter(Job.status == "queued").count()
-        p = db.query(Job).filter(Job.status == "processing").count()
-        c = db.query(Job).filter(Job.status == "completed").count()
-        f = db.query(Job).filter(Job.status == "failed").count()
-        return q, p, c, f
+        counts = dict(db.execute(text("SELECT status, COUNT(*) FROM app_jobs GROUP BY status")).all())
+        return (
+            counts.get("queued", 0),
+            counts.get("processing", 0),
+            counts.get("completed", 0),
+            counts.get("failed", 0),
+        )
     except Exception:
         return -1, -1, -1, -1
 
@@ -377,10 +1164,12 @@ def get_job_counts(db: Session):
 # ----------------------------
 # Async job processing
 # ----------------------------
-async def process_job_async(job_id: int, semaphore: asyncio.Semaphore):
+async def process_job_async(job_id: int, semaphore: asyncio.Semaphore, http_session: aiohttp.ClientSession):
     """Process a single job asynchronously."""
     async with semaphore:
         req_id = f"job{job_id}-{uuid4().hex[:8]}"
+        tokens = new_llm_stats()
+        job_llm_stats.set(tokens)
 
         # Get job from DB (in thread)
         db = SessionLocal()
@@ -392,23 +1181,41 @@ async def process_job_async(job_id: int, semaphore: asyncio.Semaphore):
 
             logger.info(f"[{req_id}] Start job id={job.id} file='{job.filename}'")
 
-            local_input = f"tmp_in_{job.id}_{int(time.time())}_{job.filename}"
-            local_output = f"tmp_out_{job.id}_{int(time.time())}_{job.filename}.txt"
+            # Private temp dir: the user-supplied filename never becomes part of a path,
+            # and everything in it goes away with a single cleanup()
+            tmp_dir = tempfile.TemporaryDirectory(prefix=f"pdfjob{job.id}_")
+            local_input = os.path.join(tmp_dir.name, "input.pdf")
+            r2_key_output = f"outputs/{job.user_id}/translated_{job.id}_{job.filename}.txt"
+            out = OutputUpload(r2_key_output)
+            uploaded = False
 
             last_page_done = int(job.word_count or 0)
-            mode = "a" if last_page_done > 0 else "w"
+            if last_page_done > 0:
+                # Pages written by the previous attempt lived in that attempt's temp output,
+                # which is gone; resuming mid-document would upload a file missing them.
+                logger.warning(f"[{req_id}] previous attempt stopped at page {last_page_done}; its output is lost, restarting from page 1")
+                last_page_done = 0
 
+            acquire_extract_pool()
             try:
                 # Download from R2 (blocking, run in thread)
                 logger.info(f"[{req_id}] Downloading from R2 key='{job.r2_key_input}'")
-                await asyncio.to_thread(s3.download_file, R2_BUCKET, job.r2_key_input, local_input)
-
-                # Count pages (blocking)
-                def count_pages():
-                    with pdfplumber.open(local_input) as pdf:
-                        return len(pdf.pages)
-
-                total_pages = await asyncio.to_thread(count_pages)
+                await asyncio.to_thread(get_s3().download_file, R2_BUCKET, job.r2_key_input, local_input, Config=TRANSFER_CFG)
+
+                # Plain text needs no parser: its pages are just read, here
+                loop = asyncio.get_running_loop()
+                text_pages = None
+                if not await asyncio.to_thread(is_pdf_file, local_input):
+                    text_pages = await asyncio.to_thread(read_text_pages, local_input)
+                    if text_pages is None:
+                        raise ValueError(f"input '{job.filename}' is neither a PDF nor UTF-8 text")
+                    logger.info(f"[{req_id}] Input is plain text; skipping PDF parsing")
+
+                # Count pages (CPU-bound, extraction pool)
+                if text_pages is not None:
+                    total_pages = len(text_pages)
+                else:
+                    total_pages = await loop.run_in_executor(get_extract_pool(), pdf_page_count, local_input)
                 logger.info(f"[{req_id}] PDF pages={total_pages} resume_from={last_page_done + 1}")
 
                 # Check user's max_pages limit
@@ -427,93 +1234,137 @@ async def process_job_async(job_id: int, semaphore: asyncio.Semaphore):
                     total_pages = user_max_pages
 
                 # Process pages with async HTTP for LLM calls
-                prev_page_tail = ""
+                async def translate_group(group, texts, batch_start, prev_text, next_batch):
+                    """Translations for one run of pages. Context comes from the source text,
+                    so runs don't depend on each other."""
+                    first_no = batch_start + group[0] + 1
+                    last_no = batch_start + group[-1] + 1
+                    group_id = f"{req_id}.p{first_no}" if len(group) == 1 else f"{req_id}.p{first_no}-{last_no}"
+
+                    if not texts[group[0]].strip():
+                        logger.info(f"[{group_id}] empty page; writing marker")
+                        return [""]
+                    if not needs_translation(texts[group[0]]):
+                        logger.info(f"[{group_id}] nothing to translate; copying page as is")
+                        return [texts[group[0]]]
+
+                    # Context: tail of the page before the run (last page of the previous batch at the edge)
+                    before = texts[group[0] - 1] if group[0] > 0 else prev_text
+                    context = get_page_tail(before, CONTEXT_CHARS) if before.strip() else None
+
+                    # Lookahead: head of the page after the run (first page of the next batch at the edge)
+                    k = group[-1]
+                    if k + 1 < len(texts):
+                        next_text = texts[k + 1]
+                    elif next_batch is not None:
+                        next_text = (await next_batch)[0]
+                    else:
+                        next_text = ""
+                    lookahead = get_page_head(next_text, 200) if next_text.strip() else None
+
+                    ctx_info = []
+                    if context:
+                        ctx_info.append(f"context={len(context)}")
+                    if lookahead:
+                        ctx_info.append(f"lookahead={len(lookahead)}")
+                    ctx_str = f" with {', '.join(ctx_info)}" if ctx_info else ""
+                    chars = sum(len(texts[k]) for k in group)
+                    logger.info(f"[{group_id}] translating (pages={len(group)}, chars={chars}){ctx_str}")
+
+                    return await translate_pages_batched(
+                        http_session, [(batch_start + k + 1, texts[k]) for k in group], group_id,
+                        context=context, lookahead=lookahead
+                    )
 
-                async with aiohttp.ClientSession() as http_session:
-                    with open(local_output, mode, encoding="utf-8") as out:
-                        for batch_start in range(last_page_done, total_pages, PDF_BATCH_SIZE):
-                            batch_end = min(batch_start + PDF_BATCH_SIZE, total_pages)
+                batches = [
+                    (start, min(start + PDF_BATCH_SIZE, total_pages))
+                    for start in range(last_page_done, total_pages, PDF_BATCH_SIZE)
+                ]
+
+                def submit_batch(b):
+                    if text_pages is not None:
+                        fut = loop.create_future()
+                        fut.set_result(text_pages[slice(*batches[b])])
+                        return fut
+                    return loop.run_in_executor(get_extract_pool(), extract_page_texts, local_input, *batches[b])
+
+                # Producer: extracts batches (one ahead, in the pool) and starts translating their
+                # page runs right away, across batch boundaries. The bounded queue keeps it at most
+                # a couple of batches ahead of the writer; llm_semaphore caps in-flight requests.
+                runs: asyncio.Queue = asyncio.Queue(maxsize=2 * PDF_BATCH_SIZE)
+
+                async def produce_runs():
+                    try:
+                        prev_text = ""
+                        next_batch = submit_batch(0) if batches else None
+                        for b, (batch_start, batch_end) in enumerate(batches):
+                            texts = await next_batch
+                            next_batch = submit_batch(b + 1) if b + 1 < len(batches) else None
                             logger.info(f"[{req_id}] Batch {batch_start + 1}-{batch_end} / {total_pages}")
 
-                            # Extract pages in thread
-                            def extract_batch():
-                                pages_data = []
-                                with pdfplumber.open(local_input) as pdf:
-                                    for i in range(batch_start, batch_end):
-                                        try:
-                                            page = pdf.pages[i]
-                                            text = page.extract_text() or ""
-                                        except Exception as e:
-                                            logger.warning(f"[{req_id}] extract_text failed page {i+1}: {e}")
-                                            text = ""
-
-                                        # Get lookahead if not last page
-                                        lookahead = None
-                                        if i + 1 < total_pages:
-                                            try:
-                                                next_page = pdf.pages[i + 1]
-                                                next_text = next_page.extract_text() or ""
-                                                if next_text.strip():
-                                                    lookahead = get_page_head(next_text, 200)
-                                            except Exception:
-                                                pass
-
-                                        pages_data.append((i, text, lookahead))
-                                return pages_data
-
-                            pages_data = await asyncio.to_thread(extract_batch)
-
-                            # Process each page
-                            for i, text, lookahead in pages_data:
-                                page_no = i + 1
-                                page_id = f"{req_id}.p{page_no}"
-
-                                if not text.strip():
-                                    logger.info(f"[{page_id}] empty page; writing marker")
-                                    out.write(f"--- Page {page_no} ---\n\n")
-                                    out.flush()
-                                    prev_page_tail = ""
-                                else:
-                                    context = prev_page_tail if prev_page_tail else None
-
-                                    ctx_info = []
-                                    if context:
-                                        ctx_info.append(f"context={len(context)}")
-                                    if lookahead:
-                                        ctx_info.append(f"lookahead={len(lookahead)}")
-                                    ctx_str = f" with {', '.join(ctx_info)}" if ctx_info else ""
-                                    logger.info(f"[{page_id}] translating (chars={len(text)}){ctx_str}")
-
-                                    # Async LLM call
-                                    translated = await translate_text_async(
-                                        http_session, text, page_id,
-                                        context=context, lookahead=lookahead
-                                    )
-                                    out.write(f"--- Page {page_no} ---\n{translated}\n\n")
-                                    out.flush()
-
-                                    prev_page_tail = get_page_tail(text, CONTEXT_CHARS)
-
-                                # Checkpoint (update DB in thread)
-                                if page_no % CHECKPOINT_EVERY_PAGES == 0:
-                                    def save_checkpoint():
-                                        job.word_count = page_no
-                                        db.commit()
-                                    await asyncio.to_thread(save_checkpoint)
-                                    logger.info(f"[{req_id}] checkpoint: page={page_no}")
-
-                            gc.collect()
-
-                # Upload output (blocking)
-                r2_key_output = f"outputs/{job.user_id}/translated_{job.id}_{job.filename}.txt"
-                logger.info(f"[{req_id}] Uploading output to R2")
-                await asyncio.to_thread(s3.upload_file, local_output, R2_BUCKET, r2_key_output)
+                            for group in group_pages(texts, LLM_PAGE_BATCH, MAX_CHARS_PER_CHUNK):
+                                task = asyncio.create_task(
+                                    translate_group(group, texts, batch_start, prev_text, next_batch)
+                                )
+                                try:
+                                    await runs.put((batch_start + group[0] + 1, batch_start + group[-1] + 1, batch_end, task))
+                                except asyncio.CancelledError:
+                                    task.cancel()
+                                    raise
+                            prev_text = texts[-1]
+                    except Exception as e:
+                        await runs.put(e)  # hand the failure to the writer
+                    else:
+                        await runs.put(None)
+
+                producer = asyncio.create_task(produce_runs())
+
+                # Writer: results in page order, then checkpoint
+                last_checkpoint = last_page_done
+                last_checkpoint_at = time.monotonic()
+                try:
+                    while True:
+                        item = await runs.get()
+                        if item is None:
+                            break
+                        if isinstance(item, Exception):
+                            raise item
+                        first_no, last_no, batch_end, task = item
+
+                        translated_pages = await task
+                        for page_no, translated in enumerate(translated_pages, start=first_no):
+                            body = f"{translated}\n\n" if translated else "\n"  # blank page: bare marker
+                            await out.write(f"--- Page {page_no} ---\n{body}".encode("utf-8"))
+
+                        # Checkpoint (update DB in thread); everything up to last_no is written
+                        if (
+                            last_no - last_checkpoint >= CHECKPOINT_COMMIT_EVERY
+                            or last_no == batch_end
+                            or time.monotonic() - last_checkpoint_at > CHECKPOINT_MAX_SECONDS
+                        ):
+                            await asyncio.to_thread(set_job_fields, db, job_id, word_count=last_no)
+                            last_checkpoint = last_no
+                            last_checkpoint_at = time.monotonic()
+                            logger.info(f"[{req_id}] checkpoint: page={last_no}")
+                finally:
+                    # Failing: stop the producer and any translations still queued
+                    producer.cancel()
+                    while not runs.empty():
+                        item = runs.get_nowait()
+                        if isinstance(item, tuple):
+                            item[3].cancel()
+
+                check_llm_stats(tokens)
+
+                # Upload the rest of the output
+                logger.info(f"[{req_id}] Finishing output upload to R2 (parts={len(out.parts)})")
+                await out.finish()
+                uploaded = True
 
                 # Finalize
-                job.status = "completed"
-                job.r2_key_output = r2_key_output
-                job.word_count = total_pages
-                db.commit()
+                set_job_fields(
+                    db, job_id, status="completed", r2_key_output=r2_key_output, word_count=total_pages
+                )
 
                 logger.info(f"[{req_id}] DONE status=completed pages={total_pages}")
 
@@ -521,25 +1372,71 @@ async def process_job_async(job_id: int, semaphore: asyncio.Semaphore):
                 logger.error(f"[{req_id}] FAILED: {e}")
                 traceback.print_exc(file=sys.stderr)
                 try:
-                    job.status = "failed"
-                    db.commit()
+                    db.rollback()  # the error may have left the transaction aborted
+                    set_job_fields(db, job_id, status="failed")
                 except Exception as e2:
                     logger.error(f"[{req_id}] failed to mark job failed: {e2}")
 
             finally:
-                # Cleanup temp files
-                for path, label in [(local_input, "input"), (local_output, "output")]:
-                    if os.path.exists(path):
-                        try:
-                            os.remove(path)
-                            logger.info(f"[{req_id}] removed temp {label}")
-                        except Exception as e:
-                            logger.warning(f"[{req_id}] failed to remove temp {label}: {e}")
+                if not uploaded:
+                    await out.abort()
+                tmp_dir.cleanup()
+                release_extract_pool()
+                # Spent either way, so failed jobs are recorded too
+                if tokens["prompt_tokens"] or tokens["completion_tokens"]:
+                    logger.info(f"[{req_id}] LLM tokens: in={tokens['prompt_tokens']} out={tokens['completion_tokens']}")
+                    try:
+                        record_token_usage(db, job, tokens)
+                    except Exception as e:
+                        db.rollback()
+                        logger.error(f"[{req_id}] failed to record token usage: {e}")
 
         finally:
             db.close()
 
 
+# ----------------------------
+# Job notifications (LISTEN/NOTIFY)
+# ----------------------------
+def start_job_listener(wake: asyncio.Event, log_failure: bool = True):
+    """
+    LISTEN on a dedicated autocommit connection and set `wake` on every NOTIFY.
+    Returns the connection, or None if it can't be opened (the loop then just polls).
+    log_failure=False: a retry during an outage that was already reported.
+    """
+    try:
+        conn = psycopg2.connect(database_url, connect_timeout=5)  # runs on the event loop: keep it short
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cur:
+            cur.execute(f"LISTEN {JOBS_CHANNEL}")
+    except Exception as e:
+        if log_failure:
+            logger.warning(f"LISTEN {JOBS_CHANNEL} unavailable, polling only until it reconnects: {e}")
+        else:
+            logger.debug(f"LISTEN {JOBS_CHANNEL} still unavailable: {e}")
+        return None
+
+    loop = asyncio.get_running_loop()
+    fd = conn.fileno()
+
+    def on_readable():
+        try:
+            conn.poll()
+        except Exception as e:
+            logger.warning(f"Job listener connection lost: {e}")
+            loop.remove_reader(fd)
+            conn.close()
+            wake.set()  # claim once now; the loop reconnects on its next pass
+            return
+        if conn.notifies:
+            conn.notifies.clear()
+            wake.set()
+
+    loop.add_reader(fd, on_readable)
+    logger.info(f"👂 Listening for new jobs on '{JOBS_CHANNEL}'")
+    return conn
+
+
 # ----------------------------
 # Async worker loop
 # ----------------------------
@@ -547,12 +1444,9 @@ async def run_worker_async():
     logger.info("=" * 70)
     logger.info("🚀 PDF Translation Worker Starting (ASYNC)")
     logger.info(f"⚡ Max concurrent jobs: {MAX_CONCURRENT_JOBS}")
-    if LLM_PROVIDER == "deepseek":
-        logger.info(f"📦 Provider: DeepSeek, Model: {DEEPSEEK_MODEL}")
-    else:
-        logger.info(f"📦 Provider: RouteLLM, Model: {ROUTELLM_MODEL}")
+    logger.info(f"📦 Provider: {LLM.name}, Model: {LLM.model}")
     logger.info(f"🪣 R2 Bucket: {R2_BUCKET}")
-    logger.info(f"⏱️ poll={POLL_SECONDS}s batch={PDF_BATCH_SIZE}")
+    logger.info(f"⏱️ poll={POLL_MIN_SECONDS}-{POLL_MAX_SECONDS}s batch={PDF_BATCH_SIZE}")
     logger.info("=" * 70)
 
     if not env_sanity():
@@ -560,13 +1454,43 @@ async def run_worker_async():
         while True:
             await asyncio.sleep(10)
 
+    # One pooled HTTP session for every job's LLM calls, closed on shutdown
+    http_session = make_llm_session()
+    try:
+        await prewarm_connections(http_session)
+        await worker_loop(http_session)
+    finally:
+        await http_session.close()
+        if _extract_pool is not None:
+            _extract_pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def worker_loop(http_session: aiohttp.ClientSession):
+    """Claim jobs and run them as tasks, forever."""
     semaphore = asyncio.Semaphore(MAX_CONCURRENT_JOBS)
     active_tasks: dict[int, asyncio.Task] = {}  # job_id -> task
     last_heartbeat = 0
+    poll_interval = POLL_MIN_SECONDS
+    job_wake = asyncio.Event()
+    listener = None
+    listener_failures = 0  # consecutive failed LISTEN connects (warned about once per outage)
+    listener_retry_at = 0.0
+    db = SessionLocal()  # one session for the loop's lifetime; reopened after errors
 
     while True:
-        db = SessionLocal()
         try:
+            db.expire_all()
+
+            if (listener is None or listener.closed) and time.monotonic() >= listener_retry_at:
+                listener = start_job_listener(job_wake, log_failure=listener_failures == 0)
+                if listener is None:
+                    listener_failures += 1
+                    listener_retry_at = time.monotonic() + min(POLL_MIN_SECONDS * 2 ** listener_failures, POLL_MAX_SECONDS)
+                else:
+                    if listener_failures:
+                        logger.info(f"LISTEN {JOBS_CHANNEL} back after {listener_failures} failed attempts")
+                    listener_failures = 0
+
             # Cleanup finished tasks
             finished = [jid for jid, task in active_tasks.items() if task.done()]
             for jid in finished:
@@ -576,48 +1500,104 @@ async def run_worker_async():
                 except Exception as e:
                     logger.error(f"Task for job {jid} failed: {e}")
 
-            # Requeue stale jobs
-            requeue_stale_processing(db, active_job_ids=set(active_tasks.keys()))
-
             # Try to claim new jobs if we have capacity
+            claimed = 0
+            queue_empty = False
             while len(active_tasks) < MAX_CONCURRENT_JOBS:
-                job = claim_next_job(db)
-                if not job:
+                job_id = claim_next_job(db, active_job_ids=set(active_tasks.keys()))
+                if not job_id:
+                    queue_empty = True
                     break
+                claimed += 1
 
-                # Skip if already being processed (race condition guard)
-                if job.id in active_tasks:
-                    logger.warning(f"[job {job.id}] already active, skipping")
-                    continue
-
-                logger.info(f"[job {job.id}] claimed -> processing (active={len(active_tasks)+1}/{MAX_CONCURRENT_JOBS})")
-                task = asyncio.create_task(process_job_async(job.id, semaphore))
-                active_tasks[job.id] = task
+                logger.info(f"[job {job_id}] claimed -> processing (active={len(active_tasks)+1}/{MAX_CONCURRENT_JOBS})")
+                task = asyncio.create_task(process_job_async(job_id, semaphore, http_session))
+                active_tasks[job_id] = task
 
             # Heartbeat
             now = time.time()
             if now - last_heartbeat > 60:
                 q, p, c, f = get_job_counts(db)
                 logger.info(f"⏳ active={len(active_tasks)}/{MAX_CONCURRENT_JOBS} queued={q} processing={p} completed={c} failed={f}")
+                prune_translation_cache(db)
                 last_heartbeat = now
 
-            if not active_tasks:
-                await asyncio.sleep(POLL_SECONDS)
-            else:
-                # Short sleep to allow task switching
-                await asyncio.sleep(1)
+            if claimed:
+                poll_interval = POLL_MIN_SECONDS
+            elif queue_empty:
+                poll_interval = min(poll_interval * POLL_BACKOFF, POLL_MAX_SECONDS)
+
+            # End the read transaction so the connection goes back to the pool while idle
+            db.rollback()
+
+            # Sleep until a NOTIFY arrives, a job finishes (freeing a slot), or the
+            # poll interval runs out (safety net for missed notifications)
+            waiter = asyncio.create_task(job_wake.wait())
+            await asyncio.wait(
+                [waiter, *active_tasks.values()], timeout=poll_interval, return_when=asyncio.FIRST_COMPLETED
+            )
+            waiter.cancel()
+            if job_wake.is_set():
+                job_wake.clear()
+                poll_interval = POLL_MIN_SECONDS
 
         except Exception as e:
             logger.error(f"Worker loop error: {e}")
             traceback.print_exc(file=sys.stderr)
+            db.close()
+            db = SessionLocal()
             await asyncio.sleep(POLL_SECONDS)
 
-        finally:
-            db.close()
+
+def wait_for_schema():
+    """
+    Tables, columns and the NOTIFY trigger the worker relies on (claim SQL, updated_at,
+    translation cache, usage rows), set up here rather than trusting the API to have
+    started first. Once, before any worker process; retried until the DB is reachable.
+    """
+    while True:
+        try:
+            ensure_schema()
+            logger.info("Database schema ready")
+            return
+        except Exception as e:
+            logger.error(f"Schema setup failed, retrying in {POLL_SECONDS}s: {e}")
+            time.sleep(POLL_SECONDS)
 
 
 def run_worker():
-    """Entry point - runs the async worker."""
+    """Entry point - runs the async worker, or supervises WORKER_PROCESSES of them."""
+    wait_for_schema()
+    if WORKER_PROCESSES <= 1:
+        asyncio.run(run_worker_async())
+        return
+
+    # spawn: each child imports models afresh and builds its own engine and connections
+    ctx = multiprocessing.get_context("spawn")
+
+    def start(i):
+        proc = ctx.Process(target=run_worker_process, name=f"worker-{i}")
+        proc.start()
+        logger.info(f"Started {proc.name} pid={proc.pid}")
+        return proc
+
+    procs = [start(i) for i in range(WORKER_PROCESSES)]
+    try:
+        while True:
+            time.sleep(POLL_SECONDS)
+            for i, proc in enumerate(procs):
+                if not proc.is_alive():
+                    logger.error(f"{proc.name} pid={proc.pid} exited with code {proc.exitcode}; restarting")
+                    procs[i] = start(i)
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.join(timeout=10)
+
+
+def run_worker_process():
+    """Body of one supervised worker process (module level, so spawn can pickle it)."""
     asyncio.run(run_worker_async())
 
 